@@ -0,0 +1,586 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Нагрузочный бенчмарк RPC-стека.
+
+Поднимает локальный сервер с контроллером ``Root`` из ``test.py`` в отдельном
+процессе, прогоняет по нему набор нагрузок и пишет результат в JSON, пригодный
+для сравнения между коммитами.
+
+*Примеры:*
+
+.. code-block:: sh
+
+    # Все нагрузки по 10 секунд в 8 клиентских потоков
+    ./bench.py run -c 8 -d 10 -o base.json
+
+    # Только батчи с разной долей атомарных методов
+    ./bench.py run -w batch:10:0 -w batch:10:0.5 -w batch:50:1 -o new.json
+
+    # Фоновое выполнение notifications
+    ./bench.py run -w notify:0.05 --set jsonrpc.async_notifications=true
+
+    # Ошибки с записью в лог: синхронно и через cherrypy.engine.async_logging
+    ./bench.py run -w fail --set 'log.error_file="/tmp/bench.log"' -o sync.json
+    ./bench.py run -w fail --set 'log.error_file="/tmp/bench.log"' --async-log -o async.json
+
+    # Сравнение двух прогонов
+    ./bench.py compare base.json new.json
+
+    # Время импорта пакета (python -X importtime), потоки и RSS после импорта
+    ./bench.py startup -r 20 -o startup.json
+
+    # Накладные расходы проверки параметров на вызов
+    ./bench.py binder -o binder.json
+
+Формат нагрузки (параметр ``-w``):
+
+    :single: единичный вызов ``test.hello``
+    :notify: notification ``test.hello``
+    :notify:S: notification ``test.sleep`` с задержкой S секунд
+    :batch:N:A: батч из N вызовов, доля A из которых - атомарные (``test.atomic_hello``)
+    :slow:S: вызов ``test.sleep`` с задержкой S секунд
+    :fail: вызов ``test.test_div`` с делением на ноль
+'''
+
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+_here = os.path.dirname(os.path.abspath(__file__))
+# Бенчмарк всегда меряет рабочую копию, а не установленный пакет
+sys.path.insert(0, os.path.dirname(_here))
+
+DEFAULT_WORKLOADS = ('single', 'notify', 'batch:10:0', 'batch:10:0.5', 'batch:50:0.1', 'slow:0.05', 'fail')
+
+
+def _request(method, params, rpc_id=0):
+    res = {'jsonrpc': '2.0', 'method': method, 'params': params}
+    if rpc_id is not None:
+        res['id'] = rpc_id
+    return res
+
+
+class Workload:
+    '''
+    Описание нагрузки: имя и готовое тело запроса
+    '''
+
+    def __init__(self, spec):
+        self.name = spec
+        kind, *args = spec.split(':')
+        if kind == 'single':
+            data = _request('test.hello', ['WORLD'])
+        elif kind == 'notify':
+            if args:
+                data = _request('test.sleep', [float(args[0])], None)
+            else:
+                data = _request('test.hello', ['WORLD'], None)
+        elif kind == 'batch':
+            size = int(args[0]) if args else 10
+            share = float(args[1]) if len(args) > 1 else 0.0
+            atomic = int(round(size * share))
+            data = [_request('test.atomic_hello' if i < atomic else 'test.hello', ['WORLD'], i)
+                    for i in range(size)]
+        elif kind == 'slow':
+            data = _request('test.sleep', [float(args[0]) if args else 0.05])
+        elif kind == 'fail':
+            data = _request('test.test_div', [1, 0])
+        else:
+            raise ValueError('Unknown workload `%s`' % spec)
+        self.body = json.dumps(data).encode('utf-8')
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _proc_stats(pid):
+    '''
+    Количество потоков и RSS (КБ) процесса. Работает только при наличии /proc.
+    '''
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            lines = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(lines['Threads']), int(lines['VmRSS'].split()[0])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    idx = max(0, min(len(values) - 1, math.ceil(p / 100.0 * len(values)) - 1))
+    return values[idx]
+
+
+class Server:
+    '''
+    Сервер в дочернем процессе (``bench.py serve``)
+    '''
+
+    def __init__(self, port, threads, settings, async_log=False):
+        self.port = port
+        cmd = [sys.executable, os.path.abspath(__file__), 'serve',
+               '--port', str(port), '--threads', str(threads)]
+        for s in settings:
+            cmd += ['--set', s]
+        if async_log:
+            cmd.append('--async-log')
+        self.proc = subprocess.Popen(cmd, cwd=_here)
+
+    def wait_ready(self, timeout=30):
+        etime = time.time() + timeout
+        while time.time() < etime:
+            if self.proc.poll() is not None:
+                raise RuntimeError('Server process exited with code %d' % self.proc.returncode)
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 0.5).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError('Server is not ready after %d seconds' % timeout)
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+class Runner:
+    '''
+    Прогон одной нагрузки: `concurrency` клиентских потоков с keep-alive
+    соединениями шлют один и тот же запрос в течение `duration` секунд
+    '''
+
+    def __init__(self, host, port, pid, concurrency, duration, warmup):
+        self.host = host
+        self.port = port
+        self.pid = pid
+        self.concurrency = concurrency
+        self.duration = duration
+        self.warmup = warmup
+
+    def _client(self, body, stop_at, measure_from, out):
+        latencies = []
+        errors = 0
+        rpc_errors = 0
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        headers = {'Content-Type': 'application/json'}
+        try:
+            while True:
+                stime = time.perf_counter()
+                if stime >= stop_at:
+                    break
+                try:
+                    conn.request('POST', '/', body, headers)
+                    resp = conn.getresponse()
+                    data = resp.read()
+                    if resp.status != 200:
+                        errors += 1
+                except (OSError, http.client.HTTPException):
+                    errors += 1
+                    conn.close()
+                    conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+                    continue
+                etime = time.perf_counter()
+                if stime < measure_from:
+                    continue
+                latencies.append(etime - stime)
+                if data:
+                    decoded = json.loads(data)
+                    items = decoded if isinstance(decoded, list) else [decoded]
+                    rpc_errors += sum(1 for i in items if 'error' in i)
+        finally:
+            conn.close()
+        out.append((latencies, errors, rpc_errors))
+
+    def run(self, workload):
+        out = []
+        samples = []
+        start = time.perf_counter()
+        measure_from = start + self.warmup
+        stop_at = measure_from + self.duration
+        clients = [threading.Thread(target=self._client, args=(workload.body, stop_at, measure_from, out))
+                   for _ in range(self.concurrency)]
+        for c in clients:
+            c.start()
+        # Пока идет нагрузка, снимаем потоки и память сервера
+        while any(c.is_alive() for c in clients):
+            if self.pid:
+                samples.append(_proc_stats(self.pid))
+            time.sleep(0.2)
+        for c in clients:
+            c.join()
+
+        latencies = sorted(l for r in out for l in r[0])
+        count = len(latencies)
+        threads = [s[0] for s in samples if s[0] is not None]
+        rss = [s[1] for s in samples if s[1] is not None]
+
+        def ms(v):
+            return None if v is None else round(v * 1000, 3)
+
+        return {
+            'workload': workload.name,
+            'concurrency': self.concurrency,
+            'duration': self.duration,
+            'requests': count,
+            'errors': sum(r[1] for r in out),
+            'rpc_errors': sum(r[2] for r in out),
+            'rps': round(count / self.duration, 2),
+            'latency_ms': {
+                'min': ms(latencies[0] if latencies else None),
+                'mean': ms(sum(latencies) / count if count else None),
+                'p50': ms(_percentile(latencies, 50)),
+                'p95': ms(_percentile(latencies, 95)),
+                'p99': ms(_percentile(latencies, 99)),
+                'max': ms(latencies[-1] if latencies else None),
+            },
+            'server': {
+                'threads_max': max(threads) if threads else None,
+                'threads_end': threads[-1] if threads else None,
+                'rss_kb_max': max(rss) if rss else None,
+                'rss_kb_end': rss[-1] if rss else None,
+            },
+        }
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=_here,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _parse_setting(setting):
+    key, _, value = setting.partition('=')
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return key, value
+
+
+def cmd_serve(args):
+    import cherrypy
+    from test import Root
+
+    cherrypy.config.update({
+        'server.socket_host': '127.0.0.1',
+        'server.socket_port': args.port,
+        'server.thread_pool': args.threads,
+        'engine.autoreload.on': False,
+        'log.screen': False,
+        'checker.on': False,
+    })
+    cherrypy.config.update(dict(_parse_setting(s) for s in args.set))
+    cherrypy.tree.mount(Root(), '')
+    if args.async_log:
+        cherrypy.engine.async_logging.enable()
+    cherrypy.engine.signals.subscribe()
+    cherrypy.engine.start()
+    cherrypy.engine.block()
+
+
+def cmd_run(args):
+    import cherrypy
+
+    workloads = [Workload(w) for w in (args.workload or DEFAULT_WORKLOADS)]
+    server = None
+    if args.url:
+        host, _, port = args.url.partition(':')
+        port = int(port or 8080)
+        pid = None
+    else:
+        host, port = '127.0.0.1', _free_port()
+        server = Server(port, args.threads, args.set, args.async_log)
+        pid = server.proc.pid
+    try:
+        if server:
+            server.wait_ready()
+        runner = Runner(host, port, pid, args.concurrency, args.duration, args.warmup)
+        results = []
+        for w in workloads:
+            r = runner.run(w)
+            results.append(r)
+            print('{workload:<16} {rps:>10.1f} req/s  p50 {latency_ms[p50]:>8} ms  '
+                  'p95 {latency_ms[p95]:>8} ms  p99 {latency_ms[p99]:>8} ms  '
+                  'err {errors}/{rpc_errors}  threads {server[threads_max]}  '
+                  'rss {server[rss_kb_max]} KB'.format(**r))
+    finally:
+        if server:
+            server.stop()
+
+    report = {
+        'meta': {
+            'revision': _git_revision(),
+            'label': args.label,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'cherrypy': cherrypy.__version__,
+            'platform': platform.platform(),
+            'server_threads': args.threads,
+            'settings': args.set,
+            'async_log': args.async_log,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+STARTUP_SCENARIOS = (
+    ('cherrypy', 'import cherrypy'),
+    ('chips', 'import chips'),
+    ('chips.rpc', 'import chips; from chips import rpc'),
+    ('chips.jinja', 'import chips, cherrypy; cherrypy.tools.jinja.env'),
+)
+
+_STARTUP_PROBE = """
+import json, threading
+try:
+    with open('/proc/self/status') as f:
+        rss = int(dict(l.split(':', 1) for l in f if ':' in l)['VmRSS'].split()[0])
+except (OSError, KeyError, ValueError):
+    rss = None
+print(json.dumps({'threads': threading.active_count(), 'rss_kb': rss}))
+"""
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else None
+
+
+def _startup_sample(code):
+    '''
+    Один запуск интерпретатора с -X importtime: суммарное время импорта (мс),
+    время выполнения процесса (мс), количество потоков и RSS после импорта
+    '''
+    stime = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code + '\n' + _STARTUP_PROBE],
+                          cwd=os.path.dirname(_here), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          check=True)
+    wall = time.perf_counter() - stime
+    total = 0
+    for line in proc.stderr.decode().splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Учитываются только модули верхнего уровня, вложенные входят в их cumulative
+        if cumulative.strip().isdigit() and not name.startswith('  '):
+            total += int(cumulative)
+    probe = json.loads(proc.stdout.decode().strip().splitlines()[-1])
+    return total / 1000.0, wall * 1000, probe['threads'], probe['rss_kb']
+
+
+def cmd_startup(args):
+    import cherrypy
+
+    results = []
+    for name, code in STARTUP_SCENARIOS:
+        samples = [_startup_sample(code) for _ in range(args.repeat)]
+        r = {
+            'workload': 'startup:%s' % name,
+            'repeat': args.repeat,
+            'import_ms': round(_median([s[0] for s in samples]), 3),
+            'wall_ms': round(_median([s[1] for s in samples]), 3),
+            'threads': _median([s[2] for s in samples]),
+            'rss_kb': _median([s[3] for s in samples if s[3] is not None]),
+        }
+        results.append(r)
+        print('{workload:<24} import {import_ms:>9} ms  wall {wall_ms:>9} ms  '
+              'threads {threads}  rss {rss_kb} KB'.format(**r))
+
+    report = {
+        'meta': {
+            'revision': _git_revision(),
+            'label': args.label,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'cherrypy': cherrypy.__version__,
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def cmd_binder(args):
+    '''
+    Накладные расходы проверки параметров rpc.expose на один вызов
+    в сравнении с прямым вызовом и с отказом через TypeError с трейсбеком
+    '''
+    import datetime
+    import timeit
+    import traceback
+    import types
+    import cherrypy
+    from chips import params
+
+    class Methods:
+
+        def plain(self, who):
+            return who
+
+        def typed(self, when: datetime.date, days: int = 1, note: str = None):
+            return when
+
+    obj = Methods()
+    plain = params.compile_binder(Methods.plain)
+    typed = params.compile_binder(Methods.typed)
+    today = datetime.date.today()
+
+    def reject_binder():
+        try:
+            plain.bind([], {'whom': 1}, True)
+        except params.BindError:
+            pass
+
+    def reject_typeerror():
+        try:
+            obj.plain(whom=1)
+        except TypeError:
+            traceback.format_exc()
+
+    cases = (
+        ('call:direct', lambda: obj.plain('WORLD')),
+        ('call:ismethod', lambda: isinstance(obj.plain, types.MethodType)),
+        ('bind:plain', lambda: plain.bind(['WORLD'], {}, True)),
+        ('bind:typed', lambda: typed.bind([today], {'days': 2}, True)),
+        ('bind:typed_unchecked', lambda: typed.bind([today], {'days': 2}, True, False)),
+        ('bind:coerce', lambda: typed.bind(['2020-02-28'], {'days': '2'}, True, True, True)),
+        ('reject:binder', reject_binder),
+        ('reject:typeerror', reject_typeerror),
+    )
+
+    results = []
+    for name, func in cases:
+        number, _ = timeit.Timer(func).autorange()
+        best = min(timeit.repeat(func, number=number, repeat=args.repeat)) / number
+        r = {'workload': name, 'ns_per_call': round(best * 1e9, 1)}
+        results.append(r)
+        print('{workload:<24} {ns_per_call:>10} ns/call'.format(**r))
+
+    report = {
+        'meta': {
+            'revision': _git_revision(),
+            'label': args.label,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'cherrypy': cherrypy.__version__,
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def cmd_compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    base_results = {r['workload']: r for r in base['results']}
+
+    def delta(old, cur):
+        if not old or cur is None:
+            return '    n/a'
+        return '%+6.1f%%' % ((cur - old) * 100.0 / old)
+
+    print('%s -> %s' % (base['meta'].get('label') or base['meta'].get('revision'),
+                        new['meta'].get('label') or new['meta'].get('revision')))
+    for r in new['results']:
+        b = base_results.get(r['workload'])
+        if not b:
+            continue
+        if 'ns_per_call' in r:
+            print('{:<24} ns/call {}'.format(r['workload'], delta(b['ns_per_call'], r['ns_per_call'])))
+            continue
+        if 'import_ms' in r:
+            print('{:<24} import {}  wall {}  rss {}'.format(
+                r['workload'],
+                delta(b['import_ms'], r['import_ms']),
+                delta(b['wall_ms'], r['wall_ms']),
+                delta(b['rss_kb'], r['rss_kb']),
+            ))
+            continue
+        print('{:<16} rps {}  p50 {}  p95 {}  p99 {}'.format(
+            r['workload'],
+            delta(b['rps'], r['rps']),
+            delta(b['latency_ms']['p50'], r['latency_ms']['p50']),
+            delta(b['latency_ms']['p95'], r['latency_ms']['p95']),
+            delta(b['latency_ms']['p99'], r['latency_ms']['p99']),
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RPC load and latency benchmark')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    p = sub.add_parser('run', help='Run workloads against a local (or given) server')
+    p.add_argument('-w', '--workload', action='append',
+                   help='Workload spec, may be repeated (default: all)')
+    p.add_argument('-c', '--concurrency', type=int, default=4, help='Client threads')
+    p.add_argument('-d', '--duration', type=float, default=5, help='Measured seconds per workload')
+    p.add_argument('--warmup', type=float, default=1, help='Warmup seconds per workload')
+    p.add_argument('-t', '--threads', type=int, default=10, help='Server thread pool size')
+    p.add_argument('--set', action='append', default=[],
+                   help='Server config `key=json_value`, e.g. jsonrpc.batch_threads_max=4')
+    p.add_argument('--async-log', action='store_true', help='Enable asynchronous batched logging in the server')
+    p.add_argument('--url', help='Use already running server `host:port` instead of a local one')
+    p.add_argument('-l', '--label', help='Label stored in the report')
+    p.add_argument('-o', '--output', help='JSON report file')
+    p.set_defaults(func=cmd_run)
+
+    p = sub.add_parser('serve', help='Run benchmark server (used internally)')
+    p.add_argument('--port', type=int, default=8080)
+    p.add_argument('--threads', type=int, default=10)
+    p.add_argument('--set', action='append', default=[])
+    p.add_argument('--async-log', action='store_true')
+    p.set_defaults(func=cmd_serve)
+
+    p = sub.add_parser('startup', help='Measure import time, threads and RSS of the package')
+    p.add_argument('-r', '--repeat', type=int, default=10, help='Interpreter runs per scenario')
+    p.add_argument('-l', '--label', help='Label stored in the report')
+    p.add_argument('-o', '--output', help='JSON report file')
+    p.set_defaults(func=cmd_startup)
+
+    p = sub.add_parser('binder', help='Measure per-call overhead of RPC parameter binding')
+    p.add_argument('-r', '--repeat', type=int, default=5, help='Timing repeats, best is reported')
+    p.add_argument('-l', '--label', help='Label stored in the report')
+    p.add_argument('-o', '--output', help='JSON report file')
+    p.set_defaults(func=cmd_binder)
+
+    p = sub.add_parser('compare', help='Compare two JSON reports')
+    p.add_argument('base')
+    p.add_argument('new')
+    p.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
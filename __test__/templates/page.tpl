@@ -0,0 +1 @@
+<html><body>Hello {{ name }}!</body></html>
@@ -0,0 +1 @@
+<html><body>{% include "part.tpl" %}</body></html>
@@ -0,0 +1,3 @@
+<html><head><title>Report</title></head><body><table>
+{% for row in rows %}<tr><td>{{ row }}</td></tr>
+{% endfor %}</table></body></html>
@@ -2,20 +2,74 @@
 # -*- coding: utf-8 -*-
 
 import cherrypy
+import datetime
+import jinja2
 import logging
-from chips import rpc
+import os
+import tempfile
+import time
+from chips import plugins, rpc
+
+
+def aggregate():
+    time.sleep(0.1)
+    return sum(range(1000))
 
 
 class Test:
 
+    totals = plugins.BackgroundValue(aggregate, ttl=2, name='totals')
+
     @rpc.expose
     def hello(self, who):
         return 'Hello %s!' % who
 
+    @rpc.atomic
+    @rpc.expose
+    def atomic_hello(self, who):
+        return 'Hello %s!' % who
+
     @rpc.expose
     def test_div(self, arg1, arg2):
         return arg1 / arg2
 
+    @rpc.expose(coerce=True)
+    def add_days(self, when: datetime.date, days: int = 1) -> str:
+        return (when + datetime.timedelta(days=days)).isoformat()
+
+    @rpc.expose
+    def weekday(self, when: datetime.date) -> int:
+        return when.weekday()
+
+    @rpc.rate_limit(1, 1)
+    @rpc.expose
+    def limited(self):
+        return True
+
+    @rpc.rate_limit(1, 1)
+    @rpc.expose
+    def limited_notify(self):
+        return True
+
+    @rpc.expose
+    def get_totals(self):
+        return {'value': self.totals.value, 'stats': self.totals.stats()}
+
+    notified = []
+
+    @rpc.expose
+    def remember(self, task, **kwargs):
+        self.notified.append(task)
+
+    @rpc.expose
+    def get_notified(self):
+        return self.notified
+
+    @rpc.expose
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        return seconds
+
 
 class Volatile:
 
@@ -35,11 +89,66 @@ class Root(rpc.RootController):
         self.vsub = Volatile('sub')
 
 
+class Web:
+
+    loader = jinja2.FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+
+    @cherrypy.expose
+    @cherrypy.tools.jinja(template='page.tpl', loader=loader, cache=True)
+    def page(self, name='WORLD'):
+        return {'name': name}
+
+    @cherrypy.expose
+    @cherrypy.tools.jinja(template='parts.tpl', loader=loader, cache=True)
+    def parts(self):
+        return {}
+
+    @cherrypy.expose
+    @cherrypy.tools.jinja(template='report.tpl', loader=loader, stream=True, stream_buffer=1024)
+    def report(self, rows='1000'):
+        return {'rows': range(int(rows))}
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def status(self):
+        status = cherrypy.engine.starter_stopper.status()
+        status['started'] = started
+        return status
+
+
+def warmup():
+    time.sleep(0.5)
+
+
+started = []
+
+capture_file = os.path.join(tempfile.gettempdir(), 'chips-test-capture.log')
+
+
+def plain_failing():
+    raise RuntimeError('on_start failure')
+
+
+def plain_ok():
+    started.append('plain_ok')
+
+
 if __name__ == '__main__':
+    for name in os.listdir(os.path.dirname(capture_file)):
+        if name.startswith(os.path.basename(capture_file)):
+            os.remove(os.path.join(os.path.dirname(capture_file), name))
+    cherrypy.config.update({'jsonrpc.async_notifications': True, 'tools.ready.on': True, 'tools.ready.hold': 5,
+                            'jsonrpc.capture_file': capture_file, 'jsonrpc.capture_max_size': 16384})
     app = cherrypy.tree.mount(Root(), '')
+    cherrypy.tree.mount(Web(), '/web')
 
     app.log.error_log.setLevel(logging.DEBUG)
 
+    cherrypy.engine.async_logging.enable()
+    cherrypy.engine.starter_stopper.add_start(warmup, critical=True, timeout=10)
+    cherrypy.engine.starter_stopper.add_start(Test.totals.refresh, name='totals', critical=True)
+    cherrypy.engine.starter_stopper.on_start.extend([plain_failing, plain_ok])
+    cherrypy.engine.task_manager.add('totals', Test.totals, 1)
     cherrypy.engine.signals.subscribe()
     cherrypy.engine.start()
     cherrypy.engine.block()
@@ -5,6 +5,17 @@ from jsonrpcclient.clients.http_client import HTTPClient
 from jsonrpcclient.requests import Request
 from jsonrpcclient.id_generators import random
 from jsonrpcclient.exceptions import ReceivedErrorResponseError
+from chips import capture, jsonrpc, logs, plugins, replay, rpc
+from cherrypy.process import wspbus
+import cherrypy
+import glob
+import json
+import logging.handlers
+import os
+import queue
+import requests
+import tempfile
+import time
 import unittest
 
 
@@ -34,6 +45,37 @@ class JsonRpcTest(unittest.TestCase):
         r = self.client.notify('test.hello', who='WORLD')
         self.assertEqual(r.text, '')
 
+    def test_single_notification_async(self):
+        stime = time.time()
+        r = self.client.notify('test.sleep', 1)
+        self.assertEqual(r.text, '')
+        self.assertLess(time.time() - stime, 0.5)
+
+    def test_single_notification_async_kwargs(self):
+        r = self.client.notify('test.remember', task='kwargs', extra=1)
+        self.assertEqual(r.text, '')
+        for _ in range(20):
+            if 'kwargs' in self.client.request('test.get_notified', id_generator=self.gen_id).data.result:
+                break
+            time.sleep(0.1)
+        else:
+            self.fail('notification was not executed')
+
+    def test_single_notification_sync(self):
+        # Сервер тестов выполняет notifications в фоне, синхронный путь проверяется без него
+        class Root(rpc.RootController):
+            notified = []
+
+            @rpc.expose
+            def remember(self, task, **kwargs):
+                self.notified.append(task)
+
+        root = Root()
+        req = jsonrpc.SingleRequest({'jsonrpc': '2.0', 'method': 'remember', 'params': {'task': 'sync', 'extra': 1}})
+        self.assertFalse(rpc._jsonrpc_conf.async_notifications)
+        self.assertIsNone(root._exec_single(req))
+        self.assertEqual(root.notified, ['sync'])
+
     def test_single_err(self):
         with self.assertRaises(ReceivedErrorResponseError) as cm:
             self.client.request('test.test_div', 10, 0,
@@ -41,6 +83,50 @@ class JsonRpcTest(unittest.TestCase):
         exception = cm.exception
         self.assertEqual(exception.args[0], 'division by zero')
 
+    def test_single_invalid_params(self):
+        for args, kwargs in (((), {}), (('WORLD', 'EXTRA'), {}), ((), {'whom': 'WORLD'})):
+            with self.assertRaises(ReceivedErrorResponseError) as cm:
+                self.client.request('test.hello', *args, id_generator=self.gen_id, **kwargs)
+            self.assertEqual(cm.exception.response.code, -32602)
+
+    def test_single_coerce(self):
+        r = self.client.request('test.add_days', when='2020-02-28', days='2',
+                                id_generator=self.gen_id)
+        self.assertEqual(r.data.result, '2020-03-01')
+        with self.assertRaises(ReceivedErrorResponseError) as cm:
+            self.client.request('test.add_days', when='2020-02-28', days='two',
+                                id_generator=self.gen_id)
+        self.assertEqual(cm.exception.response.code, -32602)
+
+    def test_single_date(self):
+        r = self.client.request('test.weekday', '2020-01-01', id_generator=self.gen_id)
+        self.assertEqual(r.data.result, 2)
+        with self.assertRaises(ReceivedErrorResponseError) as cm:
+            self.client.request('test.weekday', '01.01.2020', id_generator=self.gen_id)
+        self.assertEqual(cm.exception.response.code, -32602)
+
+    def test_single_rate_limited(self):
+        with self.assertRaises(ReceivedErrorResponseError) as cm:
+            for _ in range(2):
+                self.client.request('test.limited', id_generator=self.gen_id)
+        self.assertEqual(cm.exception.response.code, -32002)
+
+    def test_background_value(self):
+        r = self.client.request('test.get_totals', id_generator=self.gen_id)
+        self.assertEqual(r.data.result['value'], 499500)
+        stats = r.data.result['stats']
+        self.assertGreaterEqual(stats['refreshes'], 1)
+        self.assertFalse(stats['stale'])
+
+    def test_batch_rate_limited_notification(self):
+        batch = [
+            {'jsonrpc': '2.0', 'method': 'test.limited_notify'},
+            {'jsonrpc': '2.0', 'method': 'test.limited_notify'},
+            {'jsonrpc': '2.0', 'method': 'test.hello', 'params': ['WORLD'], 'id': 1},
+        ]
+        r = requests.post('http://127.0.0.1:8080', json=batch)
+        self.assertEqual(r.json(), [{'jsonrpc': '2.0', 'id': 1, 'result': 'Hello WORLD!'}])
+
     def test_batch(self):
         gen_id = iter(range(100))
         batch = (
@@ -67,6 +153,143 @@ class JsonRpcTest(unittest.TestCase):
                 self.assertEqual(r.code, -32000)
                 self.assertEqual(r.message, 'division by zero')
 
+    def test_batch_atomic(self):
+        gen_id = iter(range(100))
+        batch = (
+            Request('test.atomic_hello', 'WORLD', id_generator=gen_id),
+            Request('test.hello', 'WORLD', id_generator=gen_id),
+        )
+        resp = self.client.send(batch)
+        self.assertEqual(len(resp.data), 2)
+        for r in resp.data:
+            self.assertEqual(r.result, 'Hello WORLD!')
+
+
+class PluginsTest(unittest.TestCase):
+
+    def test_lazy_enable_twice(self):
+        bus = wspbus.Bus()
+        bus.task_manager = plugins.LazyPlugin(bus, plugins.TaskManager)
+        self.assertIsNone(bus.task_manager.plugin)
+        bus.task_manager.add('noop', lambda: None, 60)
+        manager = bus.task_manager.plugin
+        self.assertIsInstance(manager, plugins.TaskManager)
+        self.assertIs(bus.task_manager.enable(), manager)
+        self.assertIs(bus.task_manager.enable(), manager)
+
+    def test_async_logging_handler_level(self):
+        records = queue.SimpleQueue()
+        handler = logging.handlers.QueueHandler(records)
+        handler.setLevel(logging.ERROR)
+        cherrypy.log.error_log.addHandler(handler)
+        plugin = logs.AsyncLogging(wspbus.Bus())
+        try:
+            plugin.start()
+            cherrypy.log.error('skipped', severity=logging.INFO)
+            cherrypy.log.error('written', severity=logging.ERROR)
+            plugin.stop()
+        finally:
+            cherrypy.log.error_log.removeHandler(handler)
+        self.assertEqual(records.get_nowait().getMessage().split()[-1], 'written')
+        self.assertTrue(records.empty())
+
+
+class CaptureTest(unittest.TestCase):
+
+    path = os.path.join(tempfile.gettempdir(), 'chips-test-capture.log')  # jsonrpc.capture_file сервера тестов
+
+    def _find(self, marker):
+        for _ in range(20):
+            found = [(path, record) for path in glob.glob(self.path + '*') for record in capture.read(path)
+                     if marker.encode() in record[3]]
+            if found:
+                return found
+            time.sleep(0.1)
+        return []
+
+    def test_capture(self):
+        marker = 'capture-%d' % time.time_ns()
+        # Запрос больше capture_max_size сервера тестов: после записи файл ротируется
+        large = marker + '-big' + 'x' * 20000
+        for who in (marker, large):
+            requests.post('http://127.0.0.1:8080', json={'jsonrpc': '2.0', 'method': 'test.hello',
+                                                         'params': [who], 'id': 1})
+        small = self._find(marker + '"')
+        self.assertEqual(len(small), 1)
+        big = self._find(marker + '-big')
+        self.assertEqual(len(big), 1)
+        path, (stamp, duration, size, body) = big[0]
+        self.assertNotEqual(path, self.path)  # ротированный файл
+        self.assertGreater(size, 20000)
+        self.assertGreaterEqual(duration, 0)
+        self.assertEqual(json.loads(body)['params'], [large])
+        records = replay.load([small[0][0], path])
+        self.assertTrue(any(r.method == 'test.hello' and r.body == body for r in records))
+
+    def test_slot_path(self):
+        bus = wspbus.Bus()
+        bus.prefork_slot = 0
+        writer = capture.CaptureWriter(bus, self.path + '.slot')
+        for _ in range(2):
+            writer.start()
+            writer.stop()
+        self.assertEqual(writer.path, self.path + '.slot.0')
+        os.remove(writer.path)
+
+
+class JinjaTest(unittest.TestCase):
+
+    url = 'http://127.0.0.1:8080/web/page'
+
+    def test_cache_etag(self):
+        r = requests.get(self.url, params={'name': 'CACHE'})
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('Hello CACHE!', r.text)
+        etag = r.headers['ETag']
+
+        r = requests.get(self.url, params={'name': 'CACHE'}, headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.text, '')
+
+        r = requests.get(self.url, params={'name': 'OTHER'}, headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('Hello OTHER!', r.text)
+        self.assertNotEqual(r.headers['ETag'], etag)
+
+    def test_cache_include_changed(self):
+        part = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'part.tpl')
+        try:
+            for i, text in enumerate(('FIRST', 'SECOND')):
+                with open(part, 'w') as f:
+                    f.write(text)
+                os.utime(part, (time.time() + i, time.time() + i))
+                r = requests.get('http://127.0.0.1:8080/web/parts')
+                self.assertEqual(r.status_code, 200)
+                self.assertIn(text, r.text)
+        finally:
+            os.remove(part)
+
+    def test_stream(self):
+        r = requests.get('http://127.0.0.1:8080/web/report', params={'rows': 1000}, stream=True)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers.get('Transfer-Encoding'), 'chunked')
+        text = r.content.decode()
+        self.assertTrue(text.startswith('<html><head><title>Report</title>'))
+        self.assertEqual(text.count('<tr>'), 1000)
+        self.assertTrue(text.rstrip().endswith('</html>'))
+
+
+class StarterTest(unittest.TestCase):
+
+    def test_ready(self):
+        r = requests.get('http://127.0.0.1:8080/web/status')
+        self.assertEqual(r.status_code, 200)
+        status = r.json()
+        self.assertTrue(status['ready'])
+        self.assertEqual(status['start'], {'warmup': 'done', 'totals': 'done', 'on_start': 'done'})
+        # Ошибка в callable из on_start не отменяет выполнение следующих
+        self.assertEqual(status['started'], ['plain_ok'])
+
 
 if __name__ == '__main__':
     unittest.main()
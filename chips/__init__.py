@@ -2,16 +2,33 @@
 
 __version__ = '1.0'
 
+import importlib
 import cherrypy
-from . import base, rpc, plugins, jinja
+from . import base, plugins, jinja, logs
 
 # Basic
 from .base import AppTree, daemonize
 
-# Plugins
-cherrypy.engine.bg_tasks_queue = plugins.TasksQueue(cherrypy.engine)
-cherrypy.engine.task_manager = plugins.TaskManager(cherrypy.engine)
-cherrypy.engine.starter_stopper = plugins.StarterStopper(cherrypy.engine)
+# Plugins: создаются и подключаются к шине при первом обращении
+cherrypy.engine.bg_tasks_queue = plugins.LazyPlugin(cherrypy.engine, plugins.TasksQueue)
+cherrypy.engine.task_manager = plugins.LazyPlugin(cherrypy.engine, plugins.TaskManager)
+cherrypy.engine.starter_stopper = plugins.LazyPlugin(cherrypy.engine, plugins.StarterStopper)
+cherrypy.engine.async_logging = plugins.LazyPlugin(cherrypy.engine, logs.AsyncLogging)
+cherrypy.engine.bg_values_pool = plugins.LazyPlugin(cherrypy.engine, plugins.bg_values_pool)
 
-# Tools
+# Tools: jinja2 импортируется при первом использовании инструмента,
+# ready отвечает 503, пока не завершены критические задачи starter_stopper
 cherrypy.tools.jinja = jinja.JinjaTool()
+cherrypy.tools.ready = cherrypy.Tool('on_start_resource', plugins.ready_tool, priority=10)
+
+# Модули, загружаемые при первом обращении
+_lazy_modules = ('capture', 'config', 'jsonrpc', 'limits', 'params', 'replay', 'rpc', 'workers')
+_lazy_attrs = {'prefork': 'workers'}
+
+
+def __getattr__(name):
+    if name in _lazy_modules:
+        return importlib.import_module('.' + name, __name__)
+    if name in _lazy_attrs:
+        return getattr(importlib.import_module('.' + _lazy_attrs[name], __name__), name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+'''
+Запись входящих JSON-RPC запросов для воспроизведения через :mod:`chips.replay`.
+
+Каждая строка файла - JSON-массив ``[время начала (unix), длительность (мс),
+размер ответа (байт), тело запроса]``. Файл ротируется по размеру так же, как
+``logging.handlers.RotatingFileHandler``: ``capture.log`` -> ``capture.log.1`` -> ...
+'''
+
+import json
+import logging
+import os
+import queue
+import threading
+from cherrypy.process.plugins import SimplePlugin
+
+
+class CaptureWriter(SimplePlugin):
+    '''
+    Запись захваченных запросов в отдельном потоке. В потоке обработки запроса
+    выполняется только постановка в очередь, при ее переполнении запись
+    отбрасывается и учитывается в счетчике `dropped`.
+
+    В prefork-режиме работает в каждом воркере (``prefork_mode = 'every'``),
+    к имени файла добавляется номер слота воркера.
+    '''
+
+    prefork_mode = 'every'
+
+    def __init__(self, bus, path, max_size=100 * 1024 * 1024, backups=5, queue_size=10000):
+        '''
+        :param path: Файл записи
+        :param max_size: Размер файла, после которого он ротируется, байт (0 - без ротации)
+        :param backups: Количество хранимых ротированных файлов
+        :param queue_size: Размер очереди записи
+        '''
+        super(CaptureWriter, self).__init__(bus)
+        self.base_path = path
+        self.path = path
+        self.max_size = max_size
+        self.backups = backups
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.written = 0
+        self.thread = None
+        self.file = None
+
+    def start(self):
+        if self.thread:
+            return
+        slot = getattr(self.bus, 'prefork_slot', None)
+        self.path = self.base_path if slot is None else '%s.%d' % (self.base_path, slot)
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.thread = threading.Thread(target=self.run, name=type(self).__name__)
+        self.thread.start()
+        self.bus.log('Started CaptureWriter to %s' % self.path)
+    start.priority = 76
+
+    def stop(self):
+        if not self.thread:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.file.close()
+        self.file = None
+        self.bus.log('Stopped CaptureWriter: %d requests written, %d dropped' % (self.written, self.dropped))
+
+    def put(self, stamp, duration, size, body):
+        '''
+        Поставить запрос в очередь записи
+
+        :param stamp: Время начала обработки (time.time())
+        :param duration: Длительность обработки, сек
+        :param size: Размер ответа, байт
+        :param body: Тело запроса (bytes)
+        '''
+        try:
+            self.queue.put_nowait((stamp, duration, size, body))
+        except queue.Full:
+            self.dropped += 1
+
+    def _rotate(self):
+        self.file.close()
+        if self.backups:
+            for i in range(self.backups - 1, 0, -1):
+                name = '%s.%d' % (self.path, i)
+                if os.path.exists(name):
+                    os.replace(name, '%s.%d' % (self.path, i + 1))
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def _write(self, item):
+        stamp, duration, size, body = item
+        line = json.dumps([round(stamp, 6), round(duration * 1000, 3), size,
+                           body.decode('utf-8', 'replace')], ensure_ascii=False)
+        self.file.write(line + '\n')
+        self.written += 1
+
+    def run(self):
+        running = True
+        while running:
+            item = self.queue.get()
+            try:
+                # Пишем все, что накопилось, и сбрасываем файл один раз
+                while item is not None:
+                    self._write(item)
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                else:
+                    running = False
+                self.file.flush()
+                if self.max_size and self.file.tell() >= self.max_size:
+                    self._rotate()
+            except Exception:
+                self.bus.log('Error while writing captured requests', logging.ERROR, traceback=True)
+
+
+def read(path):
+    '''
+    Записи файла: (время начала, длительность мс, размер ответа, тело запроса bytes).
+    Битые строки (например, недописанная последняя) пропускаются.
+    '''
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                stamp, duration, size, body = json.loads(line)
+            except ValueError:
+                continue
+            yield stamp, duration, size, body.encode('utf-8')
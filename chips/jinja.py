@@ -1,8 +1,157 @@
 # -*- coding: utf-8 -*-
 
 import cherrypy
+import collections
+import hashlib
+import json
+import threading
+import time
 from cherrypy._cptools import Tool
-import jinja2
+
+
+class RenderCache:
+    '''
+    LRU-кэш отрендеренных страниц с ограничением по времени жизни и количеству записей.
+    Запись считается недействительной, если шаблон был перезагружен из-за изменения
+    исходника или изменился исходник одного из подключаемых им шаблонов
+    (`uptodate` - функции проверки загрузчика, см. :func:`template_uptodate`).
+    '''
+
+    Entry = collections.namedtuple('Entry', 'template uptodate body etag expires')
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.checks = {}  # (загрузчик, имя шаблона) -> (шаблон, функции проверки исходников)
+
+    def get(self, key, template):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry.template is not template or entry.expires < time.monotonic()):
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+        # Проверка исходников (обращение к файловой системе) - вне блокировки
+        if not all(check() for check in entry.uptodate):
+            with self.lock:
+                if self.entries.get(key) is entry:
+                    del self.entries[key]
+                self.misses += 1
+            return None
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.hits += 1
+        return entry
+
+    def put(self, key, template, body, ttl, uptodate=()):
+        entry = self.Entry(template, tuple(uptodate), body, make_etag(body), time.monotonic() + ttl)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def uptodate(self, env, template):
+        '''
+        Функции проверки исходников шаблона (см. :func:`template_uptodate`).
+        Разбор исходников выполняется один раз на объект шаблона и повторяется,
+        только если шаблон перезагружен или изменился один из подключаемых
+        '''
+        key = (env.loader, template.name)
+        memo = self.checks.get(key)
+        if memo is None or memo[0] is not template or not all(check() for check in memo[1]):
+            memo = (template, tuple(template_uptodate(env, template.name)))
+            self.checks[key] = memo
+        return memo[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.checks.clear()
+
+
+def template_uptodate(env, name):
+    '''
+    Функции проверки актуальности исходников шаблона и всех шаблонов, которые
+    он подключает через extends, include и import (рекурсивно). Шаблоны,
+    имена которых вычисляются при рендеринге, не учитываются.
+    '''
+    import jinja2
+    import jinja2.meta
+
+    checks = []
+    seen = set()
+    names = [name]
+    while names:
+        name = names.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        try:
+            source, _, uptodate = env.loader.get_source(env, name)
+        except jinja2.TemplateNotFound:
+            continue
+        if uptodate is not None:
+            checks.append(uptodate)
+        names.extend(n for n in jinja2.meta.find_referenced_templates(env.parse(source)) if n)
+    return checks
+
+
+def make_etag(body):
+    '''
+    Сильный ETag содержимого страницы
+    '''
+    return '"%s"' % hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+
+def context_key(context):
+    '''
+    Хэш контекста шаблона или None, если контекст не сериализуется
+    '''
+    try:
+        data = json.dumps(context, sort_keys=True, default=repr)
+    except (TypeError, ValueError):
+        return None
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def _validate_etag(etag):
+    '''
+    Выставляет ETag и отвечает 304 на совпавший If-None-Match
+    '''
+    request = cherrypy.serving.request
+    cherrypy.serving.response.headers['ETag'] = etag
+    if request.method not in ('GET', 'HEAD'):
+        return
+    conditions = [str(x) for x in request.headers.elements('If-None-Match') or []]
+    if conditions == ['*'] or etag in conditions:
+        raise cherrypy.HTTPRedirect([], 304)
+
+
+def _stream(first, rest, buffer_size):
+    '''
+    Отдача сгенерированной страницы частями не меньше buffer_size символов.
+    Первая часть отдается сразу
+    '''
+    yield first
+    buf = []
+    size = 0
+    for chunk in rest:
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield ''.join(buf)
 
 
 class JinjaHandler(cherrypy.dispatch.LateParamPageHandler):
@@ -10,10 +159,15 @@ class JinjaHandler(cherrypy.dispatch.LateParamPageHandler):
     Рендерер шаблонов
     '''
 
-    def __init__(self, next_handler, env, template):
+    def __init__(self, next_handler, env, template, cache=None, cache_ttl=60, cache_scope=None,
+                 stream_buffer=None):
         self.next_handler = next_handler
         self.template = template
         self.env = env
+        self.cache = cache
+        self.cache_ttl = cache_ttl
+        self.cache_scope = cache_scope
+        self.stream_buffer = stream_buffer
 
     def __call__(self):
         response = self.next_handler()
@@ -28,7 +182,31 @@ class JinjaHandler(cherrypy.dispatch.LateParamPageHandler):
 
         response['__template__'] = response.get('__template__', getattr(
             cherrypy.serving.response, '__template__', self.template))
-        return self.env.get_template(response['__template__']).render(response)
+        template = self.env.get_template(response['__template__'])
+        if self.cache is None:
+            if self.stream_buffer:
+                # Первая часть генерируется сразу: так контекст шаблона фиксируется
+                # до того, как окружение изменит следующий запрос, а ошибки в начале
+                # шаблона обрабатываются как обычно
+                generator = template.generate(response)
+                first = next(generator, '')
+                cherrypy.serving.response.stream = True
+                return _stream(first, generator, self.stream_buffer)
+            return template.render(response)
+
+        key = response.pop('__cache_key__', None)
+        if key is None:
+            key = context_key(response)
+            if key is None:
+                return template.render(response)
+        key = (response['__template__'], key) + self.cache_scope
+
+        entry = self.cache.get(key, template)
+        if entry is None:
+            entry = self.cache.put(key, template, template.render(response), self.cache_ttl,
+                                   self.cache.uptodate(self.env, template))
+        _validate_etag(entry.etag)
+        return entry.body
 
 
 class JinjaTool(Tool):
@@ -55,6 +233,24 @@ class JinjaTool(Tool):
         :loader: Объект класса-загрузчика шаблонов, например jinja2.FileSystemLoader.
         :newline_sequence: Последовательность символов, завершающая строку. Должна принимать
             одно из трех допустимых значений: `'\r'`, `'\n'` или `'\r\n'`.
+        :cache: Кэшировать результат рендеринга (по умолчанию выключено).
+        :cache_ttl: Время жизни записи кэша, сек.
+        :stream: Отдавать страницу по мере рендеринга (chunked), не собирая ее целиком.
+            Не используется вместе с кэшем: при включенном кэше страница рендерится целиком.
+        :stream_buffer: Минимальный размер отдаваемой части страницы при потоковом рендеринге, символов.
+
+    Кэш рендеринга. Ключ записи - имя шаблона плюс индекс результата контроллера
+    `'__cache_key__'`, а если его нет - хэш всего результата контроллера.
+    Если страница зависит от чего-то кроме результата контроллера (например,
+    от пользователя через `cherrypy.request` в шаблоне), контроллер должен
+    передать это в `'__cache_key__'`. Для закэшированных страниц выставляется
+    сильный ETag, на совпавший `If-None-Match` отдается 304 без рендеринга.
+    Записи сбрасываются при изменении исходника шаблона или шаблонов, которые он
+    подключает через extends/include/import с постоянными именами (подключаемые
+    по вычисляемому имени не отслеживаются и обновятся по истечении `cache_ttl`).
+    Кэш общий для всех обработчиков, максимальное количество записей задается
+    через `cherrypy.tools.jinja.cache.size` (по умолчанию 1000).
+    Статистика доступна в `cherrypy.tools.jinja.cache.hits` / `.misses`.
     '''
 
     def __init__(self):
@@ -64,13 +260,36 @@ class JinjaTool(Tool):
             name='jinja',
             priority=70
         )
-        self.env = jinja2.Environment(
-            extensions=['jinja2.ext.i18n'],
-            finalize=lambda x: '' if x is None else x
-        )
-        self.default_loader = jinja2.FileSystemLoader('')
+        self._env = None
+        self._default_loader = None
+        self._lock = threading.Lock()
+        self.cache = RenderCache()
 
-    def run(self, template=None, loader=None, newline_sequence='\n', gettext_translations=None):
+    def _init_env(self):
+        # jinja2 импортируется при первом использовании инструмента
+        with self._lock:
+            if self._env is None:
+                import jinja2
+                self._default_loader = jinja2.FileSystemLoader('')
+                self._env = jinja2.Environment(
+                    extensions=['jinja2.ext.i18n'],
+                    finalize=lambda x: '' if x is None else x
+                )
+
+    @property
+    def env(self):
+        if self._env is None:
+            self._init_env()
+        return self._env
+
+    @property
+    def default_loader(self):
+        if self._default_loader is None:
+            self._init_env()
+        return self._default_loader
+
+    def run(self, template=None, loader=None, newline_sequence='\n', gettext_translations=None,
+            cache=False, cache_ttl=60, stream=False, stream_buffer=8192):
         request = cherrypy.serving.request
         if not template:
             path = request.path_info.strip('/')
@@ -85,5 +304,12 @@ class JinjaTool(Tool):
             self.env.install_null_translations(True)
 
         request.jinja_env = self.env
-        request.handler = JinjaHandler(
-            cherrypy.request.handler, self.env, template)
+        if cache:
+            # Результат рендеринга зависит также от загрузчика и переводов
+            request.handler = JinjaHandler(
+                cherrypy.request.handler, self.env, template, self.cache, cache_ttl,
+                (self.env.loader, newline_sequence, gettext_translations))
+        else:
+            request.handler = JinjaHandler(
+                cherrypy.request.handler, self.env, template,
+                stream_buffer=stream_buffer if stream else None)
@@ -13,6 +13,8 @@ class Error(Exception):
     INTERNAL_ERROR = -32603
     GENERIC_APPLICATION_ERROR = -32000
     TIMEOUT = -32001
+    RATE_LIMITED = -32002
+    OVERLOADED = -32003
 
     messages = {
         PARSE_ERROR: 'Parse Error',
@@ -22,6 +24,8 @@ class Error(Exception):
         INTERNAL_ERROR: 'Internal Error',
         GENERIC_APPLICATION_ERROR: 'Application Error',
         TIMEOUT: 'Timeout',
+        RATE_LIMITED: 'Rate Limit Exceeded',
+        OVERLOADED: 'Server Overloaded',
     }
 
     def __init__(self, rpc_id, code=None, message=None, data=None):
@@ -87,6 +91,7 @@ class BatchRequest:
         if not isinstance(data, list):
             raise Error(None, code=Error.INVALID_REQUEST)
         self.data = data
+        self.running = []  # futures элементов, не завершившихся к таймауту батча
 
         self.requests = []
         for req in self.data:
@@ -99,7 +104,7 @@ class BatchRequest:
 def parse_request(raw, encoding='utf-8'):
     try:
         if isinstance(raw, (bytes, bytearray, str)):
-            data = json.loads(raw, encoding=encoding)
+            data = json.loads(raw.decode(encoding) if isinstance(raw, (bytes, bytearray)) else raw)
         else:
             data = json.load(raw)
     except Exception as e:
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+import time
+
+
+class TokenBucket:
+    '''
+    Потокобезопасный token bucket: `rate` токенов в секунду, не более `burst` накоплено
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.tokens = 0
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+        self.configure(rate, burst)
+        self.tokens = self.burst
+
+    def configure(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+
+    def take(self, count=1):
+        '''
+        Забрать `count` токенов. Возвращает False, если токенов недостаточно
+        '''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens < count:
+                return False
+            self.tokens -= count
+            return True
+
+
+class Counters:
+    '''
+    Счетчики допуска запросов одного клиента или метода
+    '''
+
+    __slots__ = ('bucket', 'accepted', 'rate_limited', 'overloaded')
+
+    def __init__(self):
+        self.bucket = None
+        self.accepted = 0
+        self.rate_limited = 0
+        self.overloaded = 0
+
+    def as_dict(self):
+        return {
+            'accepted': self.accepted,
+            'rate_limited': self.rate_limited,
+            'overloaded': self.overloaded,
+        }
+
+
+def _limit(value):
+    '''
+    Лимит из конфигурации: rate или (rate, burst). None - без ограничения
+    '''
+    if value is None:
+        return None, None
+    if isinstance(value, (list, tuple)):
+        return value[0], value[1] if len(value) > 1 else None
+    return value, None
+
+
+class Admission:
+    '''
+    Контроль допуска вызовов: token bucket на каждого клиента и на каждый метод
+    и ограничение общего количества одновременно выполняемых вызовов.
+
+    Параметры читаются из пространства имен конфигурации при каждом запросе:
+
+        :client_rate: Лимит вызовов в секунду на клиента: rate или [rate, burst]
+        :method_rate_limits: Лимиты методов {имя: rate или [rate, burst]},
+            перекрывают лимиты, заданные декоратором ``rpc.rate_limit``
+        :max_in_flight: Максимум одновременно выполняемых вызовов (с учетом элементов батчей)
+        :clients_max: Максимум отслеживаемых клиентов, давно не обращавшиеся вытесняются
+    '''
+
+    RATE_LIMITED = 'rate_limited'
+    OVERLOADED = 'overloaded'
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.clients = collections.OrderedDict()
+        self.methods = {}
+        self.declared_limits = False  # есть методы с лимитом, заданным декоратором
+
+    def enabled(self):
+        return bool(self.declared_limits or self.conf.client_rate or
+                    self.conf.method_rate_limits or self.conf.max_in_flight)
+
+    def _client(self, key):
+        with self.lock:
+            counters = self.clients.get(key)
+            if counters is None:
+                counters = self.clients[key] = Counters()
+                while len(self.clients) > self.conf.clients_max:
+                    self.clients.popitem(last=False)
+            else:
+                self.clients.move_to_end(key)
+        return counters
+
+    def _method(self, name):
+        counters = self.methods.get(name)
+        if counters is None:
+            with self.lock:
+                counters = self.methods.setdefault(name, Counters())
+        return counters
+
+    @staticmethod
+    def _take(counters, rate, burst):
+        if not rate:
+            return True
+        bucket = counters.bucket
+        if bucket is None:
+            bucket = counters.bucket = TokenBucket(rate, burst)
+        elif bucket.rate != rate or (burst is not None and bucket.burst != burst):
+            bucket.configure(rate, burst)
+        return bucket.take()
+
+    def admit(self, client, method, method_limit=None):
+        '''
+        Допуск одного вызова. Возвращает None, если вызов допущен (и занимает
+        слот, который нужно освободить через `release`), иначе причину отказа
+        '''
+        client_counters = self._client(client)
+        method_counters = self._method(method)
+
+        refusal = None
+        rate, burst = _limit(self.conf.client_rate)
+        if not self._take(client_counters, rate, burst):
+            refusal = self.RATE_LIMITED
+        else:
+            rate, burst = _limit(self.conf.method_rate_limits.get(method, method_limit))
+            if not self._take(method_counters, rate, burst):
+                refusal = self.RATE_LIMITED
+
+        # Счетчики изменяются из многих потоков запросов, поэтому под блокировкой
+        with self.lock:
+            if refusal is None:
+                if self.conf.max_in_flight and self.in_flight >= self.conf.max_in_flight:
+                    refusal = self.OVERLOADED
+                else:
+                    self.in_flight += 1
+            if refusal is None:
+                client_counters.accepted += 1
+                method_counters.accepted += 1
+            elif refusal == self.RATE_LIMITED:
+                client_counters.rate_limited += 1
+                method_counters.rate_limited += 1
+            else:
+                client_counters.overloaded += 1
+                method_counters.overloaded += 1
+        return refusal
+
+    def release(self, count=1):
+        with self.lock:
+            self.in_flight -= count
+
+    def stats(self):
+        '''
+        Текущее состояние и счетчики по клиентам и методам
+        '''
+        with self.lock:
+            return {
+                'in_flight': self.in_flight,
+                'max_in_flight': self.conf.max_in_flight,
+                'clients': {k: v.as_dict() for k, v in self.clients.items()},
+                'methods': {k: v.as_dict() for k, v in self.methods.items()},
+            }
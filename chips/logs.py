@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+import cherrypy
+import logging
+import queue
+import sys
+import threading
+import time
+from cherrypy.process.plugins import SimplePlugin
+
+from . import config
+
+
+# Конфигурация по умолчанию
+_logs_conf = config.Namespace('chips_log', {
+    'repeat_window': 10,  # Окно ограничения повторяющихся ошибок, сек (0 - без ограничения)
+    'repeat_burst': 5,  # Сколько одинаковых ошибок пишется за окно, остальные подавляются
+})
+
+
+class _RepeatLimiter:
+    '''
+    Ограничитель повторяющихся одинаковых сообщений: за окно пишется не более
+    `burst` сообщений с одним ключом, остальные только подсчитываются
+    '''
+
+    max_keys = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = {}  # ключ -> [начало окна, записано в окне, подавлено]
+
+    def check(self, key, window, burst):
+        '''
+        Возвращает (писать ли сообщение, сколько подавлено с прошлого записанного)
+        '''
+        now = time.monotonic()
+        with self.lock:
+            state = self.state.get(key)
+            if state is None or now - state[0] >= window:
+                suppressed = state[2] if state else 0
+                if len(self.state) >= self.max_keys:
+                    self.state.clear()
+                self.state[key] = [now, 1, 0]
+                return True, suppressed
+            if state[1] < burst:
+                state[1] += 1
+                suppressed, state[2] = state[2], 0
+                return True, suppressed
+            state[2] += 1
+            return False, 0
+
+
+_limiter = _RepeatLimiter()
+
+
+def _log_manager():
+    request = cherrypy.serving.request
+    app = getattr(request, 'app', None)
+    return getattr(app, 'log', None) or cherrypy.log
+
+
+def log(context, severity, msg, *args, traceback=False, repeat_key=None):
+    '''
+    Запись в лог CherryPy (лог текущего приложения или глобальный).
+    Сообщение форматируется через `msg.format(*args)` только если
+    уровень severity включен. Одинаковые сообщения уровня WARNING и выше
+    (ключ - контекст, уровень, шаблон сообщения, `repeat_key` и тип исключения)
+    ограничиваются параметрами ``chips_log.repeat_window`` и ``chips_log.repeat_burst``,
+    количество подавленных дописывается к следующему записанному.
+
+    :param context: Контекст сообщения, например `'RPC'`
+    :param severity: Уровень logging
+    :param msg: Шаблон сообщения
+    :param traceback: Добавить трейсбек текущего исключения
+    :param repeat_key: Дополнительный ключ для различения повторяющихся сообщений
+    '''
+    manager = _log_manager()
+    if not manager.error_log.isEnabledFor(severity):
+        return
+    suppressed = 0
+    if severity >= logging.WARNING and _logs_conf.repeat_window:
+        exc_type = sys.exc_info()[0] if traceback else None
+        allowed, suppressed = _limiter.check((context, severity, msg, repeat_key, exc_type),
+                                             _logs_conf.repeat_window, _logs_conf.repeat_burst)
+        if not allowed:
+            return
+    if args:
+        msg = msg.format(*args)
+    if suppressed:
+        msg = '%s (%d similar messages suppressed)' % (msg, suppressed)
+    manager.error(msg, context, severity, traceback)
+
+
+class _EnqueueHandler(logging.Handler):
+    '''
+    Обработчик, ставящий записи в очередь асинхронного логирования
+    вместо исходных обработчиков логгера
+    '''
+
+    def __init__(self, plugin, targets):
+        super(_EnqueueHandler, self).__init__()
+        self.plugin = plugin
+        self.targets = targets
+
+    def emit(self, record):
+        try:
+            self.plugin.queue.put_nowait((record, self.targets))
+        except queue.Full:
+            self.plugin.dropped += 1
+
+
+class AsyncLogging(SimplePlugin):
+    '''
+    Асинхронное логирование. При запуске шины обработчики логов CherryPy
+    (глобальных и всех смонтированных приложений) заменяются постановкой
+    записей в очередь, а запись выполняет отдельный поток пачками до
+    `batch_size` записей (блокировка обработчика берется один раз на пачку).
+    Форматирование (включая трейсбеки) тоже выполняется в этом потоке.
+    При переполнении очереди записи отбрасываются, их количество
+    периодически пишется в лог. По ``graceful`` файлы логов переоткрываются.
+    При остановке шины очередь дописывается, исходные обработчики возвращаются.
+
+    Настройки логов (``log.screen``, ``log.error_file`` и т.п.) должны быть
+    заданы до запуска шины.
+
+    Плагин подключается к шине при первом обращении (или вызове ``enable()``)
+    и доступен под именем ``cherrypy.engine.async_logging``.
+    В prefork-режиме работает в каждом воркере (``prefork_mode = 'every'``).
+    '''
+
+    prefork_mode = 'every'
+
+    def __init__(self, bus, queue_size=10000, batch_size=100, flush_interval=0.5):
+        super(AsyncLogging, self).__init__(bus)
+        self.queue = queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.thread = None
+        self._replaced = []
+        self._error_targets = ()
+
+    def _loggers(self):
+        managers = [cherrypy.log] + [app.log for app in cherrypy.tree.apps.values()]
+        for manager in managers:
+            yield manager.error_log
+            yield manager.access_log
+
+    def start(self):
+        if self.thread:
+            return
+        self._error_targets = tuple(cherrypy.log.error_log.handlers)
+        for logger in self._loggers():
+            if logger.handlers and not any(isinstance(h, _EnqueueHandler) for h in logger.handlers):
+                targets = tuple(logger.handlers)
+                self._replaced.append((logger, targets))
+                logger.handlers = [_EnqueueHandler(self, targets)]
+        self.thread = threading.Thread(target=self.run, name=type(self).__name__)
+        self.thread.start()
+        self.bus.log('Started AsyncLogging')
+    start.priority = 10
+
+    def stop(self):
+        if not self.thread:
+            return
+        for logger, targets in self._replaced:
+            logger.handlers = list(targets)
+        self._replaced = []
+        self.queue.put((None, None))
+        self.thread.join()
+        self.thread = None
+        self.bus.log('Stopped AsyncLogging')
+    stop.priority = 90
+
+    def graceful(self):
+        '''
+        Переоткрытие файлов логов (например, после logrotate), как это делает
+        ``LogManager.reopen_files`` для исходных обработчиков
+        '''
+        for _, targets in self._replaced:
+            for handler in targets:
+                if not isinstance(handler, logging.FileHandler):
+                    continue
+                handler.acquire()
+                try:
+                    if handler.stream:
+                        handler.stream.close()
+                    handler.stream = handler._open()
+                finally:
+                    handler.release()
+
+    def _write(self, batch):
+        grouped = {}
+        for record, targets in batch:
+            for handler in targets:
+                # Уровень обработчика logging проверяет в Logger.callHandlers, handle() его не учитывает
+                if record.levelno >= handler.level:
+                    grouped.setdefault(handler, []).append(record)
+        # Запись через handle(), чтобы работали ротация и переоткрытие файлов
+        # обработчиков, блокировка обработчика берется один раз на пачку
+        for handler, records in grouped.items():
+            handler.acquire()
+            try:
+                for record in records:
+                    handler.handle(record)
+                handler.flush()
+            finally:
+                handler.release()
+
+    def run(self):
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if any(record is None for record, _ in batch):
+                batch = [item for item in batch if item[0] is not None]
+                running = False
+            if batch:
+                self._write(batch)
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                logger = cherrypy.log.error_log
+                record = logger.makeRecord(logger.name, logging.WARNING, __file__, 0,
+                                           '%s ASYNCLOG %d log records dropped: queue is full' %
+                                           (cherrypy.log.time(), dropped), None, None)
+                self._write([(record, self._error_targets)])
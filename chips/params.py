@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import inspect
+import types
+import typing
+
+
+class BindError(Exception):
+    '''
+    Параметры вызова не соответствуют сигнатуре метода
+    '''
+    pass
+
+
+_TRUE = ('true', '1', 'yes', 'on')
+_FALSE = ('false', '0', 'no', 'off')
+
+
+def _to_int(value):
+    if isinstance(value, str):
+        return int(value)
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    raise ValueError()
+
+
+def _to_float(value):
+    if isinstance(value, str):
+        return float(value)
+    raise ValueError()
+
+
+def _to_str(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    raise ValueError()
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        lowered = value.lower()
+        if lowered in _TRUE:
+            return True
+        if lowered in _FALSE:
+            return False
+    elif isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    raise ValueError()
+
+
+def _to_datetime(value):
+    if isinstance(value, str):
+        return datetime.datetime.fromisoformat(value)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.datetime.fromtimestamp(value)
+    raise ValueError()
+
+
+def _to_date(value):
+    if isinstance(value, str):
+        return datetime.date.fromisoformat(value)
+    raise ValueError()
+
+
+# тип -> (проверка значения без приведения, приведение при несовпадении типа)
+_TYPES = {
+    int: (lambda v: isinstance(v, int) and not isinstance(v, bool), _to_int),
+    float: (lambda v: isinstance(v, (int, float)) and not isinstance(v, bool), _to_float),
+    str: (lambda v: isinstance(v, str), _to_str),
+    bool: (lambda v: isinstance(v, bool), _to_bool),
+    list: (lambda v: isinstance(v, list), None),
+    tuple: (lambda v: isinstance(v, list), None),
+    dict: (lambda v: isinstance(v, dict), None),
+    datetime.datetime: (lambda v: isinstance(v, datetime.datetime), _to_datetime),
+    datetime.date: (lambda v: isinstance(v, datetime.date), _to_date),
+}
+
+# Типы без представления в JSON: строки ISO 8601 приводятся к ним и без coerce
+_ISO_TYPES = {
+    datetime.datetime: datetime.datetime.fromisoformat,
+    datetime.date: datetime.date.fromisoformat,
+}
+
+
+def _checker(annotation):
+    '''
+    Функция проверки (и приведения) значения по аннотации типа или None,
+    если тип не относится к базовым
+    '''
+    optional = False
+    origin = typing.get_origin(annotation)
+    if origin is typing.Union or origin is getattr(types, 'UnionType', None):
+        variants = typing.get_args(annotation)
+        rest = [a for a in variants if a is not type(None)]
+        if len(rest) != 1:
+            return None
+        optional = len(rest) != len(variants)
+        annotation = rest[0]
+        origin = typing.get_origin(annotation)
+    tp = origin or annotation
+    if tp not in _TYPES:
+        return None
+    is_instance, convert = _TYPES[tp]
+    from_iso = _ISO_TYPES.get(tp)
+    name = tp.__name__
+
+    def check(value, coerce, param):
+        if value.__class__ is tp:
+            return value
+        if is_instance(value):
+            if tp is float:
+                return float(value)
+            if tp is tuple:
+                return tuple(value)
+            return value
+        if value is None and optional:
+            return value
+        if from_iso is not None and isinstance(value, str):
+            try:
+                return from_iso(value)
+            except ValueError:
+                pass
+        elif coerce and convert is not None:
+            try:
+                return convert(value)
+            except (ValueError, TypeError, OverflowError):
+                pass
+        raise BindError('Parameter `%s` must be %s, got %s' % (param, name, type(value).__name__))
+    return check
+
+
+class _Spec:
+    '''
+    Скомпилированное описание параметров
+    '''
+
+    def __init__(self, params, hints):
+        self.positional = []  # имена позиционных параметров по порядку
+        self.index = {}  # имя -> позиция
+        self.keyword = set()  # допустимые именованные параметры
+        self.required = []  # обязательные параметры (позиция или None для keyword-only)
+        self.checkers = {}  # имя -> проверка типа
+        self.var_positional = False
+        self.var_keyword = False
+
+        for p in params:
+            if p.kind == p.VAR_POSITIONAL:
+                self.var_positional = True
+                continue
+            if p.kind == p.VAR_KEYWORD:
+                self.var_keyword = True
+                continue
+            if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD):
+                self.index[p.name] = len(self.positional)
+                self.positional.append(p.name)
+            if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY):
+                self.keyword.add(p.name)
+            if p.default is p.empty:
+                self.required.append(p.name)
+            if p.name in hints:
+                checker = _checker(hints[p.name])
+                if checker:
+                    self.checkers[p.name] = checker
+        self.max_positional = len(self.positional)
+        # При стольких позиционных аргументах все обязательные параметры заданы
+        self.min_positional = max([self.index[n] + 1 for n in self.required if n in self.index] or [0])
+        if any(n not in self.index for n in self.required):
+            self.min_positional = self.max_positional + 1
+        # (позиция, имя, проверка) позиционных параметров с проверкой типа
+        self.positional_checkers = [(self.index[n], n, c) for n, c in self.checkers.items() if n in self.index]
+        self.positional_checkers.sort()
+
+    def bind(self, args, kwargs, check_types, coerce):
+        count = len(args)
+        if count > self.max_positional and not self.var_positional:
+            raise BindError('Expected at most %d positional parameters, got %d' %
+                            (self.max_positional, count))
+        if kwargs:
+            for name in kwargs:
+                if name not in self.keyword:
+                    if not self.var_keyword:
+                        raise BindError('Unexpected parameter `%s`' % name)
+                elif self.index.get(name, count) < count:
+                    raise BindError('Multiple values for parameter `%s`' % name)
+        if count < self.min_positional:
+            for name in self.required:
+                if self.index.get(name, count) >= count and name not in kwargs:
+                    raise BindError('Missing required parameter `%s`' % name)
+
+        if check_types and self.checkers:
+            if count and self.positional_checkers:
+                args = list(args)
+                for i, name, checker in self.positional_checkers:
+                    if i >= count:
+                        break
+                    args[i] = checker(args[i], coerce, name)
+            if kwargs:
+                checkers = self.checkers
+                kwargs = dict(kwargs)
+                for name, value in kwargs.items():
+                    checker = checkers.get(name)
+                    if checker:
+                        kwargs[name] = checker(value, coerce, name)
+        return args, kwargs
+
+
+class Binder:
+    '''
+    Проверка параметров вызова по сигнатуре и аннотациям типов метода,
+    скомпилированная один раз. Проверяются количество позиционных параметров,
+    имена именованных, наличие обязательных и базовые типы (int, float, str,
+    bool, list, tuple, dict, datetime, date, Optional[...] от них).
+    Строки ISO 8601 для datetime и date приводятся всегда, остальные
+    типы - только с `coerce`. Остальные аннотации не проверяются.
+    '''
+
+    def __init__(self, func, coerce=None):
+        '''
+        :param func: Функция или метод
+        :param coerce: Приводить значения к типам аннотаций (например, str -> int).
+            None - по настройке вызывающей стороны
+        '''
+        signature = inspect.signature(func)
+        try:
+            hints = typing.get_type_hints(func)
+        except Exception:
+            hints = {}
+        params = list(signature.parameters.values())
+        self.coerce = coerce
+        self.unbound = _Spec(params, hints)
+        # Для связанного метода первый параметр (self) уже подставлен
+        self.bound = _Spec(params[1:], hints) if params and params[0].kind in (
+            params[0].POSITIONAL_ONLY, params[0].POSITIONAL_OR_KEYWORD) else self.unbound
+
+    def bind(self, args, kwargs, bound=False, check_types=True, coerce=False):
+        '''
+        Проверка параметров. Возвращает (args, kwargs), возможно с приведенными
+        значениями, или выбрасывает BindError
+
+        :param bound: Вызывается связанный метод
+        :param check_types: Проверять типы
+        :param coerce: Приводить типы, если не задано при создании
+        '''
+        spec = self.bound if bound else self.unbound
+        return spec.bind(args, kwargs, check_types, coerce if self.coerce is None else self.coerce)
+
+
+def compile_binder(func, coerce=None):
+    '''
+    Binder для функции или None, если сигнатуру получить невозможно
+    '''
+    try:
+        return Binder(func, coerce)
+    except (TypeError, ValueError):
+        return None
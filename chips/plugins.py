@@ -1,10 +1,71 @@
 # -*- coding: utf-8 -*-
 
+import cherrypy
 from cherrypy.process.plugins import SimplePlugin
 import threading
 import logging
 from cherrypy.process.wspbus import states
 import queue
+import time
+
+
+def prefork_allowed(bus, plugin):
+    '''
+    Может ли плагин работать в текущем процессе с учетом prefork-режима:
+    плагины с ``prefork_mode = 'primary'`` работают только в воркере со слотом 0
+    '''
+    slot = getattr(bus, 'prefork_slot', None)
+    return not slot or getattr(plugin, 'prefork_mode', 'every') != 'primary'
+
+
+class LazyPlugin:
+    '''
+    Заглушка плагина, которая создает плагин и подключает его к шине
+    при первом обращении к любому его атрибуту или при вызове `enable()`.
+    Заглушка остается на месте и передает обращения созданному плагину,
+    поэтому `enable()` можно вызывать повторно.
+    Если шина к этому моменту запущена, плагин запускается сразу.
+
+    *Пример:*
+
+    .. code-block:: python
+
+        cherrypy.engine.task_manager = LazyPlugin(cherrypy.engine, TaskManager)
+        ...
+        cherrypy.engine.task_manager.add('cleanup', cleanup, 60)  # здесь плагин будет создан
+    '''
+
+    def __init__(self, bus, factory, *args, **kwargs):
+        self._bus = bus
+        self._factory = factory
+        self._args = args
+        self._kwargs = kwargs
+        self._plugin = None
+        self._lock = threading.Lock()
+
+    @property
+    def plugin(self):
+        '''
+        Созданный плагин или None, если он еще не создан
+        '''
+        return self._plugin
+
+    def enable(self):
+        '''
+        Создать плагин и подключить его к шине, если это еще не сделано
+        '''
+        with self._lock:
+            if self._plugin is None:
+                plugin = self._factory(self._bus, *self._args, **self._kwargs)
+                if prefork_allowed(self._bus, plugin):
+                    plugin.subscribe()
+                    if self._bus.state in (states.STARTING, states.STARTED):
+                        plugin.start()
+                self._plugin = plugin
+        return self._plugin
+
+    def __getattr__(self, name):
+        return getattr(self._plugin or self.enable(), name)
 
 
 class ExitThread(Exception):
@@ -52,9 +113,11 @@ class TasksQueue(IterativePlugin):
     они являются потокобезопасными друг относительно друга и могут
     использовать какие-либо общие ресурсы.
 
-    Плагин подключается к шине автоматически и доступен под именем
+    Плагин подключается к шине при первом обращении и доступен под именем
     ``cherrypy.engine.bg_tasks_queue``
 
+    В prefork-режиме работает в каждом воркере (``prefork_mode = 'every'``).
+
     *Пример:*
 
     .. code-block:: python
@@ -77,6 +140,8 @@ class TasksQueue(IterativePlugin):
 
     '''
 
+    prefork_mode = 'every'
+
     def __init__(self, bus, queue_size=100, timeout=2):
         super(TasksQueue, self).__init__(bus)
         self.queue = queue.Queue(queue_size)
@@ -102,6 +167,124 @@ class TasksQueue(IterativePlugin):
         self.queue.put((task, args, kwargs))
 
 
+class TasksPool(SimplePlugin):
+    '''
+    Пул потоков с ограниченной очередью задач (callables).
+    В отличие от TasksQueue задачи выполняются параллельно в `threads` потоках,
+    которые создаются после запуска шины, когда для задачи нет свободного потока.
+
+    Политика при переполнении очереди (`overflow`):
+
+        :'drop': задача отбрасывается и учитывается в счетчике `dropped`
+        :'inline': задача выполняется в вызывающем потоке
+        :'block': вызывающий поток ждет освобождения места в очереди
+
+    Пока шина не запущена, задачи выполняются в вызывающем потоке.
+
+    В prefork-режиме работает в каждом воркере (``prefork_mode = 'every'``).
+    '''
+
+    prefork_mode = 'every'
+
+    DROP = 'drop'
+    INLINE = 'inline'
+    BLOCK = 'block'
+
+    def __init__(self, bus, threads=4, queue_size=1000, overflow=DROP, name=None):
+        super(TasksPool, self).__init__(bus)
+        self.name = name or type(self).__name__
+        self.threads = threads
+        self.overflow = overflow
+        self.queue = queue.Queue(queue_size)
+        self.running = False
+        self._threads = []
+        self._idle = 0  # потоки, ожидающие задачу
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(('submitted', 'completed', 'failed', 'dropped', 'inline'), 0)
+
+    def start(self):
+        self.running = True
+        self.bus.log('Started %s' % self.name)
+    start.priority = 76
+
+    def stop(self):
+        self.bus.log('Stopping %s...' % self.name)
+        with self._lock:
+            self.running = False
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+        self.bus.log('Stopped %s' % self.name)
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def _execute(self, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+            self._count('completed')
+        except:
+            self._count('failed')
+            self.bus.log('Error in task {}'.format(func),
+                         level=logging.ERROR, traceback=True)
+
+    def run(self):
+        self.bus.publish('acquire_thread')
+        while True:
+            with self._lock:
+                self._idle += 1
+            item = self.queue.get()
+            with self._lock:
+                self._idle -= 1
+            if item is None:
+                break
+            self._execute(*item)
+        self.bus.publish('release_thread')
+
+    def _spawn(self):
+        with self._lock:
+            # Новый поток нужен, если свободных потоков не больше, чем задач в очереди
+            if not self.running or len(self._threads) >= self.threads or self._idle > self.queue.qsize():
+                return
+            thread = threading.Thread(target=self.run, name='%s-%d' % (self.name, len(self._threads)))
+            self._threads.append(thread)
+        thread.start()
+
+    def put(self, task, *args, **kwargs):
+        '''
+        Поставить задачу в очередь. Возвращает False, если задача отброшена
+        '''
+        self._count('submitted')
+        if not self.running:
+            self._count('inline')
+            self._execute(task, args, kwargs)
+            return True
+        self._spawn()
+        try:
+            self.queue.put((task, args, kwargs), block=self.overflow == self.BLOCK)
+        except queue.Full:
+            if self.overflow == self.INLINE:
+                self._count('inline')
+                self._execute(task, args, kwargs)
+                return True
+            self._count('dropped')
+            return False
+        return True
+
+    def stats(self):
+        '''
+        Счетчики задач и текущая длина очереди
+        '''
+        with self._lock:
+            res = dict(self.counters)
+        res['queued'] = self.queue.qsize()
+        res['threads'] = len(self._threads)
+        return res
+
+
 class TaskManager(SimplePlugin):
     '''
     Менеджер асинхронных фоновых задач, исполняющихся через
@@ -109,11 +292,17 @@ class TaskManager(SimplePlugin):
     Менеджер пытается соблюдать интервал между запусками задачи, однако, если задача выполняется
     дольше установленного для нее интервала, менеджер будет запсукать ее с фактической
     частотой.
+    Для значений, пересчитываемых в фоне и читаемых обработчиками, см. :class:`BackgroundValue`.
 
-    Плагин подключается к шине автоматически и доступен под именем
+    Плагин подключается к шине при первом обращении и доступен под именем
     ``cherrypy.engine.task_manager``
+
+    В prefork-режиме работает только в воркере со слотом 0 (``prefork_mode = 'primary'``),
+    чтобы периодические задачи не выполнялись в каждом воркере.
     '''
 
+    prefork_mode = 'primary'
+
     def __init__(self, bus):
         super(TaskManager, self).__init__(bus)
         self._tasks = {}
@@ -178,21 +367,296 @@ class TaskManager(SimplePlugin):
         self._tasks.clear()
 
 
-class StarterStopper(SimplePlugin):
+def bg_values_pool(bus):
+    '''
+    Пул пересчетов BackgroundValue при чтении, доступен под именем ``cherrypy.engine.bg_values_pool``
+    '''
+    return TasksPool(bus, threads=2, queue_size=100, name='BackgroundValues')
+
+
+class BackgroundValue:
+    '''
+    Значение, вычисляемое в фоне (refresh-ahead). Обработчики читают последний
+    опубликованный снимок через `value` без блокировок и ожидания, а пересчет
+    выполняется задачей ``cherrypy.engine.task_manager`` (объект регистрируется
+    как обычная задача) и, если задан `ttl` и снимок старше `refresh_ahead` * `ttl`,
+    при очередном чтении в пуле ``cherrypy.engine.bg_values_pool``.
+
+    Если вычисление упало, продолжает отдаваться предыдущее значение
+    (stale-while-revalidate), повторный пересчет при чтении - не чаще, чем раз
+    в `retry_interval` секунд. Статистику пересчетов и устаревания возвращает :meth:`stats`.
+
+    Поскольку ``task_manager`` в prefork-режиме работает только в воркере
+    со слотом 0, в остальных воркерах значение обновляется только при чтении,
+    то есть при заданном `ttl`. Без `ttl` в этих воркерах значение не
+    обновляется, о чем при первом пересчете пишется предупреждение.
+
+    *Пример:*
+
+    .. code-block:: python
+
+        class Reports:
+
+            totals = plugins.BackgroundValue(calc_totals, ttl=60, name='totals')
+
+            @rpc.expose
+            def get_totals(self):
+                return self.totals.value
+
+        cherrypy.engine.task_manager.add('totals', Reports.totals, 50)
+        cherrypy.engine.starter_stopper.add_start(Reports.totals.refresh, name='totals', critical=True)
     '''
-    Плагин, имеющий два списка callable: on_start и on_stop.
-    Функции из on_start выполняются в отдельном потоке сразу после запуска шины.
-    Функции из on_stop выполняются в основном потоке в процессе остановки шины.
 
-    Плагин подключается к шине автоматически и доступен под именем
+    def __init__(self, func, ttl=None, refresh_ahead=0.8, retry_interval=5, default=None,
+                 name=None, args=(), kwargs=None, pool=None):
+        '''
+        :param func: Callable, вычисляющий значение
+        :param ttl: Время жизни значения, сек. None - значение обновляется только по
+            расписанию, без пересчета при чтении (в prefork-режиме - только в воркере со слотом 0)
+        :param refresh_ahead: Доля ttl, после которой чтение запускает фоновый пересчет
+        :param retry_interval: Минимальный интервал пересчетов при чтении после ошибки, сек
+        :param default: Значение до первого успешного вычисления
+        :param name: Имя для лога
+        :param args: Аргументы, с которыми будет вызываться func
+        :param kwargs: Именованные аргументы, с которыми будет вызываться func
+        :param pool: TasksPool для пересчетов при чтении, по умолчанию ``cherrypy.engine.bg_values_pool``
+        '''
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.ttl = ttl
+        self.ahead = ttl * refresh_ahead if ttl else None
+        self.retry_interval = retry_interval
+        self.default = default
+        self.name = name or getattr(func, '__name__', None) or repr(func)
+        self._snapshot = None  # (значение, время вычисления), заменяется целиком
+        self._ready = threading.Event()
+        self._refreshing = threading.Lock()
+        self._queued = False  # пересчет уже поставлен в пул
+        self._retry_at = 0
+        self._warned = False
+        self.pool = pool
+        self._stats_lock = threading.Lock()
+        self.counters = {
+            'refreshes': 0,
+            'failures': 0,
+            'consecutive_failures': 0,
+            'last_duration': None,
+            'max_duration': 0,
+            'total_duration': 0,
+            'max_staleness': 0,
+            'last_error': None,
+        }
+
+    @property
+    def value(self):
+        '''
+        Последнее вычисленное значение (или `default`)
+        '''
+        snapshot = self._snapshot
+        if self.ahead is not None and (snapshot is None or time.monotonic() - snapshot[1] >= self.ahead):
+            self._refresh_async()
+        return self.default if snapshot is None else snapshot[0]
+
+    def wait(self, timeout=None):
+        '''
+        Дождаться первого вычисления значения. Возвращает False по таймауту
+        '''
+        if self._snapshot is None:
+            self._refresh_async()
+        return self._ready.wait(timeout)
+
+    def _refresh_async(self):
+        if self._queued or self._refreshing.locked() or time.monotonic() < self._retry_at:
+            return
+        self._queued = True
+        if not (self.pool or cherrypy.engine.bg_values_pool).put(self.refresh):
+            self._queued = False
+
+    def refresh(self):
+        '''
+        Пересчитать и опубликовать значение. Если пересчет уже выполняется,
+        ничего не делает. Возвращает True при успешном вычислении
+        '''
+        self._queued = False
+        if not self._refreshing.acquire(blocking=False):
+            return False
+        if self.ttl is None and not self._warned and getattr(cherrypy.engine, 'prefork_slot', None):
+            self._warned = True
+            cherrypy.engine.log('Background value {} has no ttl: prefork workers other than slot 0 '
+                                'will not refresh it'.format(self.name), logging.WARNING)
+        try:
+            stime = time.monotonic()
+            try:
+                value = self.func(*self.args, **self.kwargs)
+                error = None
+            except Exception as e:
+                error = e
+                cherrypy.engine.log('Error while refreshing background value {}'.format(self.name),
+                                    logging.ERROR, traceback=True)
+            now = time.monotonic()
+            previous = self._snapshot
+            if error is None:
+                self._snapshot = (value, now)
+                self._ready.set()
+            else:
+                self._retry_at = now + self.retry_interval
+            self._count(now - stime, now - previous[1] if previous else 0, error)
+            return error is None
+        finally:
+            self._refreshing.release()
+
+    __call__ = refresh
+
+    def _count(self, duration, staleness, error):
+        with self._stats_lock:
+            c = self.counters
+            c['refreshes'] += 1
+            c['last_duration'] = duration
+            c['max_duration'] = max(c['max_duration'], duration)
+            c['total_duration'] += duration
+            c['max_staleness'] = max(c['max_staleness'], staleness)
+            if error is None:
+                c['consecutive_failures'] = 0
+            else:
+                c['failures'] += 1
+                c['consecutive_failures'] += 1
+                c['last_error'] = repr(error)
+
+    def stats(self):
+        '''
+        Счетчики пересчетов, их длительность (сек), текущий возраст значения
+        и максимальный возраст, до которого оно устаревало перед пересчетом
+        '''
+        with self._stats_lock:
+            res = dict(self.counters)
+        res['mean_duration'] = res.pop('total_duration') / res['refreshes'] if res['refreshes'] else None
+        snapshot = self._snapshot
+        res['age'] = time.monotonic() - snapshot[1] if snapshot else None
+        res['stale'] = bool(self.ttl and (snapshot is None or res['age'] > self.ttl))
+        return res
+
+
+class _Hook:
+    '''
+    Задача запуска или остановки StarterStopper
+    '''
+
+    __slots__ = ('name', 'func', 'requires', 'timeout', 'critical')
+
+    def __init__(self, name, func, requires=(), timeout=None, critical=False):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.timeout = timeout
+        self.critical = critical
+
+
+class StarterStopper(SimplePlugin):
+    '''
+    Плагин, имеющий два списка задач: on_start и on_stop.
+    Задачи из on_start выполняются после запуска шины, задачи из on_stop -
+    в процессе остановки шины.
+
+    Задачи, добавленные через :meth:`add_start` и :meth:`add_stop`, выполняются
+    параллельно в отдельных потоках с учетом зависимостей (задача запускается
+    после успешного завершения всех задач из `requires`) и таймаутов. Задача,
+    зависящая от упавшей или не уложившейся в таймаут, пропускается.
+    Поток задачи, превысившей таймаут, не прерывается, но его результат
+    больше не учитывается. Для задач остановки таймаут по умолчанию - `stop_timeout`.
+
+    Callables, добавленные в списки ``on_start``/``on_stop`` напрямую, как и
+    раньше выполняются последовательно друг за другом без таймаута, ошибка
+    одного из них не отменяет выполнение следующих. Callables из ``on_start``
+    выполняются одной задачей ``'on_start'`` параллельно с остальными задачами
+    запуска, из ``on_stop`` - в потоке остановки шины перед остальными задачами
+    остановки.
+
+    Сервис считается готовым (событие `ready`, канал шины ``'ready'``), когда
+    успешно завершены все задачи запуска с ``critical=True``. Пока сервис
+    не готов, инструмент ``tools.ready`` отвечает на запросы 503 или
+    задерживает их до `hold` секунд. Состояния задач возвращает :meth:`status`.
+
+    Плагин подключается к шине при первом обращении и доступен под именем
     ``cherrypy.engine.starter_stopper``
+
+    В prefork-режиме работает в каждом воркере (``prefork_mode = 'every'``),
+    воркер сообщает мастеру о готовности только после `ready`.
+
+    *Пример:*
+
+    .. code-block:: python
+
+        starter = cherrypy.engine.starter_stopper
+        starter.add_start(db.connect, critical=True, timeout=30)
+        starter.add_start(cache.warm, requires=['connect'], critical=True)
+        starter.add_start(stats.load)  # параллельно с остальными, готовность не ждет
+        starter.add_stop(db.close)
+
+        cherrypy.config.update({'tools.ready.on': True, 'tools.ready.hold': 5})
     '''
 
-    def __init__(self, bus):
+    prefork_mode = 'every'
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    TIMEOUT = 'timeout'
+    SKIPPED = 'skipped'
+
+    def __init__(self, bus, stop_timeout=30):
         super(StarterStopper, self).__init__(bus)
         self.thread = None
         self.on_start = []
         self.on_stop = []
+        self.stop_timeout = stop_timeout
+        self.ready = threading.Event()
+        self.states = {'start': {}, 'stop': {}}
+        self._lock = threading.Lock()
+
+    def _add(self, hooks, func, name, requires, timeout, critical):
+        name = name or getattr(func, '__name__', None) or repr(func)
+        if any(isinstance(h, _Hook) and h.name == name for h in hooks):
+            raise ValueError('Hook `%s` is already added' % name)
+        hooks.append(_Hook(name, func, requires, timeout, critical))
+
+    def add_start(self, func, name=None, requires=(), timeout=None, critical=False):
+        '''
+        Добавить задачу запуска
+
+        :param func: Callable без аргументов
+        :param name: Уникальное имя задачи, по умолчанию имя функции
+        :param requires: Имена задач запуска, которые должны успешно завершиться до этой
+        :param timeout: Максимальное время выполнения, сек (None - без ограничения)
+        :param critical: Сервис не готов, пока задача не завершится успешно
+        '''
+        self._add(self.on_start, func, name, requires, timeout, critical)
+
+    def add_stop(self, func, name=None, requires=(), timeout=None):
+        '''
+        Добавить задачу остановки
+
+        :param func: Callable без аргументов
+        :param name: Уникальное имя задачи, по умолчанию имя функции
+        :param requires: Имена задач остановки, которые должны завершиться до этой
+        :param timeout: Максимальное время выполнения, сек (по умолчанию `stop_timeout`)
+        '''
+        self._add(self.on_stop, func, name, requires, timeout, False)
+
+    def status(self):
+        '''
+        Готовность и состояния задач запуска и остановки
+        '''
+        with self._lock:
+            return {
+                'ready': self.ready.is_set(),
+                'start': dict(self.states['start']),
+                'stop': dict(self.states['stop']),
+            }
+
+    def wait_ready(self, timeout=None):
+        return self.ready.wait(timeout)
 
     def start(self):
         if not self.thread:
@@ -201,11 +665,13 @@ class StarterStopper(SimplePlugin):
     start.priority = 75
 
     def stop(self):
+        self.ready.clear()
         if self.thread:
             self.thread.join()
             self.thread = None
-        for task in self.on_stop:
-            task()
+        # Callables, добавленные напрямую, как и раньше выполняются в потоке остановки шины
+        self._run_plain(self.on_stop, 'stop')
+        self._run_hooks('stop', [h for h in self.on_stop if isinstance(h, _Hook)], self.stop_timeout)
         self.bus.log('Stopper succesfully worked')
 
     def run(self):
@@ -214,15 +680,149 @@ class StarterStopper(SimplePlugin):
         self.bus.wait((states.STARTED, states.STOPPING, states.EXITING))
 
         if self.bus.state == states.STARTED:
-            for task in self.on_start:
-                try:
-                    task()
-                except:
-                    self.bus.log('An exception occured in on_start task {}'.format(
-                        task), logging.ERROR, traceback=True)
+            self._run_hooks('start', self._start_hooks(), None)
+            if not self.ready.is_set():
+                self.bus.log('Critical on_start tasks failed, service is not ready', logging.ERROR)
             self.bus.log('Starter succesfully worked')
         else:
             self.bus.log(
                 'Wrong bus state, starter tasks are ignored', logging.WARNING)
 
         self.bus.publish('release_thread')
+
+    def _run_plain(self, items, kind):
+        '''
+        Callables, добавленные в список напрямую: последовательно, как раньше,
+        ошибка одного не отменяет выполнение следующих
+        '''
+        for task in items:
+            if isinstance(task, _Hook):
+                continue
+            try:
+                task()
+            except:
+                self.bus.log('An exception occured in on_{} task {}'.format(
+                    kind, task), logging.ERROR, traceback=True)
+
+    def _start_hooks(self):
+        '''
+        Задачи запуска. Callables, добавленные в ``on_start`` напрямую,
+        выполняются одной задачей ``'on_start'`` без таймаута
+        '''
+        hooks = [h for h in self.on_start if isinstance(h, _Hook)]
+        if len(hooks) != len(self.on_start):
+            hooks.append(_Hook('on_start', lambda: self._run_plain(self.on_start, 'start')))
+        return hooks
+
+    def _check_ready(self, hooks):
+        if self.ready.is_set() or self.bus.state != states.STARTED:
+            return
+        with self._lock:
+            current = self.states['start']
+            if any(h.critical and current.get(h.name) != self.DONE for h in hooks):
+                return
+        self.ready.set()
+        self.bus.log('Service is ready')
+        self.bus.publish('ready')
+
+    def _call(self, hook, kind, done):
+        self.bus.publish('acquire_thread')
+        stime = time.monotonic()
+        try:
+            hook.func()
+            ok = True
+        except:
+            ok = False
+            self.bus.log('An exception occured in on_{} task {}'.format(kind, hook.name),
+                         logging.ERROR, traceback=True)
+        done.put((hook.name, ok, time.monotonic() - stime))
+        self.bus.publish('release_thread')
+
+    def _set_state(self, kind, name, state):
+        with self._lock:
+            self.states[kind][name] = state
+
+    def _run_hooks(self, kind, hooks, default_timeout):
+        '''
+        Выполнение задач с учетом зависимостей и таймаутов
+        '''
+        names = set(h.name for h in hooks)
+        with self._lock:
+            current = self.states[kind] = {h.name: self.PENDING for h in hooks}
+        for hook in hooks:
+            missing = [r for r in hook.requires if r not in names]
+            if missing:
+                self.bus.log('on_{} task {} requires unknown tasks: {}'.format(
+                    kind, hook.name, ', '.join(missing)), logging.ERROR)
+                self._set_state(kind, hook.name, self.FAILED)
+        if kind == 'start':
+            self._check_ready(hooks)
+
+        done = queue.Queue()
+        deadlines = {}  # имя выполняемой задачи -> крайний срок или None
+        while True:
+            progress = True
+            while progress:
+                progress = False
+                for hook in hooks:
+                    if current[hook.name] != self.PENDING:
+                        continue
+                    required = [current[r] for r in hook.requires]
+                    if any(state in (self.FAILED, self.TIMEOUT, self.SKIPPED) for state in required):
+                        self.bus.log('on_{} task {} skipped: required task was not completed'.format(
+                            kind, hook.name), logging.WARNING)
+                        self._set_state(kind, hook.name, self.SKIPPED)
+                        progress = True
+                    elif all(state == self.DONE for state in required):
+                        timeout = hook.timeout if hook.timeout is not None else default_timeout
+                        deadlines[hook.name] = time.monotonic() + timeout if timeout is not None else None
+                        self._set_state(kind, hook.name, self.RUNNING)
+                        threading.Thread(target=self._call, args=(hook, kind, done),
+                                         name='%s-%s' % (type(self).__name__, hook.name), daemon=True).start()
+            if not deadlines:
+                break
+
+            limited = [d for d in deadlines.values() if d is not None]
+            try:
+                name, ok, duration = done.get(timeout=max(0, min(limited) - time.monotonic()) if limited else None)
+            except queue.Empty:
+                now = time.monotonic()
+                for name, deadline in list(deadlines.items()):
+                    if deadline is not None and deadline <= now:
+                        del deadlines[name]
+                        self._set_state(kind, name, self.TIMEOUT)
+                        self.bus.log('on_{} task {} timed out'.format(kind, name), logging.ERROR)
+                continue
+            if name not in deadlines:
+                continue  # завершилась задача, уже снятая по таймауту
+            del deadlines[name]
+            self._set_state(kind, name, self.DONE if ok else self.FAILED)
+            if ok:
+                self.bus.log('on_{} task {} completed in {:.3f} s'.format(kind, name, duration))
+            if kind == 'start':
+                self._check_ready(hooks)
+
+        for hook in hooks:
+            if current[hook.name] == self.PENDING:
+                self.bus.log('on_{} task {} is not executed: circular dependency'.format(
+                    kind, hook.name), logging.ERROR)
+                self._set_state(kind, hook.name, self.FAILED)
+
+
+def ready_tool(hold=0, retry_after=5):
+    '''
+    Инструмент ``tools.ready``: пока критические задачи запуска
+    ``cherrypy.engine.starter_stopper`` не завершены, запрос ждет готовности
+    до `hold` секунд, после чего получает ответ 503 с заголовком Retry-After
+    '''
+    starter = cherrypy.engine.starter_stopper
+    if isinstance(starter, LazyPlugin):
+        starter = starter.plugin
+    if not isinstance(starter, StarterStopper) or starter.wait_ready(hold):
+        return
+    response = cherrypy.serving.response
+    response.status = 503
+    response.headers['Retry-After'] = str(retry_after)
+    response.headers['Content-Type'] = 'text/plain'
+    response.body = b'Service is starting'
+    cherrypy.serving.request.handler = None
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Воспроизведение запросов, записанных в режиме захвата ``jsonrpc.capture_file``,
+на локальном (или любом другом) сервере со сравнением задержек по методам.
+
+*Примеры:*
+
+.. code-block:: sh
+
+    # С исходными интервалами между запросами
+    python -m chips.replay capture.log.1 capture.log --url 127.0.0.1:8080
+
+    # В 5 раз быстрее исходного
+    python -m chips.replay capture.log --speed 5
+
+    # С максимальной скоростью в 32 потока, отчет в JSON
+    python -m chips.replay capture.log --speed 0 -c 32 -o base.json
+
+    # Та же запись на новой сборке в сравнении с предыдущим прогоном
+    python -m chips.replay capture.log --speed 0 -c 32 --baseline base.json
+
+Для каждого метода выводятся количество вызовов, медиана и 95-й перцентиль
+длительности обработки на сервере при записи и задержки клиента при
+воспроизведении, а с ``--baseline`` - изменение медианы и 95-го перцентиля
+задержки относительно предыдущего прогона. Длительность при записи не
+включает сеть и HTTP, поэтому сравнивать сборки нужно по прогонам.
+Батч-запросы учитываются под именем ``batch``, непарсящиеся - ``<invalid>``.
+Отчет в JSON совместим с ``__test__/bench.py compare``.
+'''
+
+import argparse
+import http.client
+import json
+import math
+import threading
+import time
+
+from . import capture
+
+
+class Record:
+    '''
+    Записанный запрос
+    '''
+
+    __slots__ = ('stamp', 'duration', 'size', 'body', 'method')
+
+    def __init__(self, stamp, duration, size, body):
+        self.stamp = stamp
+        self.duration = duration
+        self.size = size
+        self.body = body
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = None
+        if isinstance(data, list):
+            self.method = 'batch'
+        elif isinstance(data, dict) and isinstance(data.get('method'), str):
+            self.method = data['method']
+        else:
+            self.method = '<invalid>'
+
+
+def load(paths, limit=None):
+    '''
+    Записи из файлов захвата, упорядоченные по времени
+    '''
+    records = [Record(*item) for path in paths for item in capture.read(path)]
+    records.sort(key=lambda r: r.stamp)
+    return records[:limit] if limit else records
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, math.ceil(p / 100.0 * len(values)) - 1))]
+
+
+class Replay:
+    '''
+    Воспроизведение записей `concurrency` потоками с keep-alive соединениями.
+    При `speed` > 0 запросы отправляются с исходными интервалами, деленными
+    на `speed`, при `speed` = 0 - без пауз
+    '''
+
+    def __init__(self, records, host, port, path='/', concurrency=8, speed=1.0):
+        self.records = records
+        self.host = host
+        self.port = port
+        self.path = path
+        self.concurrency = concurrency
+        self.speed = speed
+        self.results = [None] * len(records)  # (задержка мс, ошибка HTTP, отставание от расписания сек)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _take(self):
+        with self._lock:
+            index = self._next
+            self._next += 1
+        return index if index < len(self.records) else None
+
+    def _client(self, start):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        headers = {'Content-Type': 'application/json'}
+        origin = self.records[0].stamp if self.records else 0
+        try:
+            while True:
+                index = self._take()
+                if index is None:
+                    break
+                record = self.records[index]
+                lag = 0
+                if self.speed:
+                    due = start + (record.stamp - origin) / self.speed
+                    lag = time.perf_counter() - due
+                    if lag < 0:
+                        time.sleep(-lag)
+                        lag = 0
+                stime = time.perf_counter()
+                try:
+                    conn.request('POST', self.path, record.body, headers)
+                    resp = conn.getresponse()
+                    resp.read()
+                    error = resp.status != 200
+                except (OSError, http.client.HTTPException):
+                    error = True
+                    conn.close()
+                    conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+                self.results[index] = ((time.perf_counter() - stime) * 1000, error, lag)
+        finally:
+            conn.close()
+
+    def run(self):
+        start = time.perf_counter()
+        clients = [threading.Thread(target=self._client, args=(start,)) for _ in range(self.concurrency)]
+        for c in clients:
+            c.start()
+        for c in clients:
+            c.join()
+        return time.perf_counter() - start
+
+    def report(self, elapsed):
+        '''
+        Результаты по методам в формате отчетов ``bench.py``
+        '''
+        methods = {}
+        for record, result in zip(self.records, self.results):
+            if result is not None:
+                methods.setdefault(record.method, []).append((record, result))
+
+        def ms(v):
+            return None if v is None else round(v, 3)
+
+        results = []
+        for method, items in sorted(methods.items()):
+            captured = [r.duration for r, _ in items]
+            replayed = [res[0] for _, res in items]
+            results.append({
+                'workload': 'replay:%s' % method,
+                'requests': len(items),
+                'errors': sum(1 for _, res in items if res[1]),
+                'rps': round(len(items) / elapsed, 2) if elapsed else None,
+                'captured_ms': {'p50': ms(_percentile(captured, 50)), 'p95': ms(_percentile(captured, 95))},
+                'latency_ms': {
+                    'p50': ms(_percentile(replayed, 50)),
+                    'p95': ms(_percentile(replayed, 95)),
+                    'p99': ms(_percentile(replayed, 99)),
+                    'max': ms(max(replayed)),
+                },
+            })
+        lags = [res[2] for res in self.results if res is not None]
+        return results, max(lags) if lags else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay captured JSON-RPC traffic and compare latencies')
+    parser.add_argument('files', nargs='+', help='Capture files (rotated files may be given in any order)')
+    parser.add_argument('--url', default='127.0.0.1:8080', help='Server `host:port`')
+    parser.add_argument('--path', default='/', help='RPC endpoint path')
+    parser.add_argument('-s', '--speed', type=float, default=1.0,
+                        help='Speed factor relative to the capture, 0 - as fast as possible')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='Client threads')
+    parser.add_argument('-n', '--limit', type=int, help='Replay only first N requests')
+    parser.add_argument('-b', '--baseline', help='Previous JSON report to compare latencies with')
+    parser.add_argument('-l', '--label', help='Label stored in the report')
+    parser.add_argument('-o', '--output', help='JSON report file')
+    args = parser.parse_args(argv)
+
+    records = load(args.files, args.limit)
+    if not records:
+        parser.error('no captured requests found')
+    host, _, port = args.url.partition(':')
+    replay = Replay(records, host, int(port or 8080), args.path, args.concurrency, args.speed)
+    elapsed = replay.run()
+    results, lag = replay.report(elapsed)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {r['workload']: r for r in json.load(f)['results']}
+
+    def delta(old, cur):
+        if not old or cur is None:
+            return 'n/a'
+        return '%+.1f%%' % ((cur - old) * 100.0 / old)
+
+    print('%d requests in %.2f s, max schedule lag %.3f s' % (len(records), elapsed, lag))
+    line = '{:<32} {:>7} {:>6} {:>12} {:>12} {:>10} {:>10} {:>9} {:>9}'
+    print(line.format('method', 'count', 'err', 'server p50', 'server p95', 'p50 ms', 'p95 ms',
+                      'p50 diff', 'p95 diff'))
+    for r in results:
+        b = baseline.get(r['workload'], {}).get('latency_ms', {})
+        print(line.format(
+            r['workload'][len('replay:'):], r['requests'], r['errors'],
+            r['captured_ms']['p50'], r['captured_ms']['p95'],
+            r['latency_ms']['p50'], r['latency_ms']['p95'],
+            delta(b.get('p50'), r['latency_ms']['p50']), delta(b.get('p95'), r['latency_ms']['p95'])))
+
+    if args.output:
+        report = {
+            'meta': {
+                'label': args.label,
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'files': args.files,
+                'speed': args.speed,
+                'concurrency': args.concurrency,
+                'elapsed': round(elapsed, 3),
+                'max_lag': round(lag, 3),
+            },
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
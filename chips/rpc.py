@@ -2,18 +2,39 @@
 
 import json
 import logging
+import random
 import concurrent.futures
+import functools
 import time
 import cherrypy
+import types
 import typing
 
+from . import capture
 from . import config
 from . import jsonrpc
+from . import limits
+from . import logs
+from . import params
+from . import plugins
 
 
-def expose(entity):
-    entity.__rpc_exposed = True
-    return entity
+def expose(entity=None, coerce=None):
+    '''
+    Публикация метода через JSON-RPC. Параметры вызова проверяются по сигнатуре
+    и аннотациям типов метода до его выполнения, при несоответствии клиент
+    получает INVALID_PARAMS.
+
+    Используется как ``@rpc.expose`` или ``@rpc.expose(coerce=True)``
+
+    :param coerce: Приводить параметры к типам аннотаций (например, str -> int),
+        по умолчанию - по параметру конфигурации ``jsonrpc.coerce_params``
+    '''
+    def decorator(entity):
+        entity.__rpc_exposed = True
+        entity.__rpc_binder = params.compile_binder(entity, coerce)
+        return entity
+    return decorator(entity) if entity is not None else decorator
 
 
 def atomic(entity):
@@ -21,14 +42,69 @@ def atomic(entity):
     return entity
 
 
+def rate_limit(rate, burst=None):
+    '''
+    Ограничение частоты вызовов метода (от всех клиентов суммарно)
+
+    :param rate: Вызовов в секунду
+    :param burst: Максимальный всплеск, по умолчанию равен rate
+    '''
+    def decorator(entity):
+        entity.__rpc_rate_limit = (rate, burst)
+        admission.declared_limits = True
+        return entity
+    return decorator
+
+
 # Конфигурация по умолчанию
 _jsonrpc_conf = config.Namespace('jsonrpc', {
     'encoding': 'utf-8',
     'threaded_batch': True,  # Выполнять батч-запросы в параллельных потоках
     'batch_threads_max': 10,  # Максимум одновременно порождаемых потоков на один батч
     'batch_timeout': 600,  # 10 минут по умолчанию
+    'client_rate': None,  # Лимит вызовов в секунду на клиента: rate или [rate, burst]
+    'client_header': None,  # Заголовок с идентификатором клиента, по умолчанию - IP
+    'method_rate_limits': {},  # Лимиты методов {имя: rate или [rate, burst]}
+    'max_in_flight': None,  # Максимум одновременно выполняемых вызовов
+    'clients_max': 10000,  # Максимум отслеживаемых клиентов
+    'async_notifications': False,  # Отвечать на notification сразу, выполняя его в фоне
+    'notification_threads': 4,  # Потоков для фонового выполнения notifications
+    'notification_queue_size': 1000,  # Размер очереди notifications
+    'notification_overflow': 'drop',  # При переполнении очереди: drop, inline или block
+    'check_param_types': True,  # Проверять типы параметров по аннотациям методов
+    'coerce_params': False,  # Приводить параметры к типам аннотаций
+    'capture_file': None,  # Файл записи входящих запросов для chips.replay (None - не записывать)
+    'capture_sample': 1.0,  # Доля записываемых запросов
+    'capture_max_size': 100 * 1024 * 1024,  # Размер файла записи, после которого он ротируется
+    'capture_backups': 5,  # Количество хранимых ротированных файлов записи
 })
 
+# Контроль допуска, счетчики доступны через admission.stats()
+admission = limits.Admission(_jsonrpc_conf)
+
+
+def _notifications_pool(bus):
+    return plugins.TasksPool(bus,
+                             threads=_jsonrpc_conf.notification_threads,
+                             queue_size=_jsonrpc_conf.notification_queue_size,
+                             overflow=_jsonrpc_conf.notification_overflow,
+                             name='RPCNotifications')
+
+
+# Пул фонового выполнения notifications, создается при первом notification.
+# Счетчики доступны через notifications.stats()
+notifications = plugins.LazyPlugin(cherrypy.engine, _notifications_pool)
+
+
+def _capture_writer(bus):
+    return capture.CaptureWriter(bus, _jsonrpc_conf.capture_file,
+                                 max_size=_jsonrpc_conf.capture_max_size,
+                                 backups=_jsonrpc_conf.capture_backups)
+
+
+# Запись входящих запросов, создается при первом записываемом запросе
+recorder = plugins.LazyPlugin(cherrypy.engine, _capture_writer)
+
 
 def _no_request_processing_tool():
     '''Инструмент для отключения обработки содержимого POST'''
@@ -63,38 +139,54 @@ class RootController:
         req - jsonrpc.SingleRequest или jsonrpc.Error
         '''
         if isinstance(req, jsonrpc.Error):
-            cherrypy.log('Could not parse JSON request',
-                         'RPC', severity=logging.ERROR)
+            logs.log('RPC', logging.ERROR, 'Could not parse JSON request')
             return req
 
-        cherrypy.log('call (id={}) "{}"'.format(req.rpc_id, req.method),
-                     'RPC', severity=logging.DEBUG)
+        logs.log('RPC', logging.DEBUG, 'call (id={}) "{}"', req.rpc_id, req.method)
 
         method = self._find_method(req.method)
         if not method:
-            cherrypy.log('Method "{}" not found (id={})'.format(req.method, req.rpc_id),
-                         'RPC', severity=logging.ERROR)
+            logs.log('RPC', logging.ERROR, 'Method "{}" not found (id={})', req.method, req.rpc_id)
             if req.rpc_id is not None:
                 return jsonrpc.Error(req.rpc_id,
                                      code=jsonrpc.Error.METHOD_NOT_FOUND)
             return None
 
+        binder = getattr(method, '__rpc_binder', None)
+        if binder is not None:
+            # Проверяем параметры до вызова
+            try:
+                args, kwargs = binder.bind(req.args, req.kwargs, isinstance(method, types.MethodType),
+                                           _jsonrpc_conf.check_param_types, _jsonrpc_conf.coerce_params)
+            except params.BindError as e:
+                logs.log('RPC', logging.DEBUG, 'Invalid parameters for "{}" (id={}): {}', req.method, req.rpc_id, e)
+                if req.rpc_id is not None:
+                    return jsonrpc.Error(req.rpc_id, code=jsonrpc.Error.INVALID_PARAMS, data=str(e))
+                return None
+        else:
+            args, kwargs = req.args, req.kwargs
+
         if req.rpc_id is None:
             # Это просто Notification, выполняем его, ответа и сообщений об ошибках быть не должно
+            if _jsonrpc_conf.async_notifications:
+                # Ставим в фоновый пул и сразу отвечаем. Параметры связываются заранее,
+                # чтобы не пересекаться с параметрами самого put()
+                notifications.put(functools.partial(method, *args, **kwargs))
+                return None
             try:
-                method(*req.args, **req.kwargs)
+                method(*args, **kwargs)
             except:
-                cherrypy.log('Error while executing notification handler "{}" (id={})'.format(req.method, req.rpc_id),
-                             'RPC', severity=logging.ERROR, traceback=True)
+                logs.log('RPC', logging.ERROR, 'Error while executing notification handler "{}" (id={})',
+                         req.method, req.rpc_id, traceback=True, repeat_key=req.method)
             return None
 
         try:
             # Выполняем метод
-            res = method(*req.args, **req.kwargs)
+            res = method(*args, **kwargs)
             return res if req.rpc_id is not None else None
         except Exception as e:
-            cherrypy.log('Error while executing method handler "{}" (id={})'.format(req.method, req.rpc_id),
-                         'RPC', severity=logging.ERROR, traceback=True)
+            logs.log('RPC', logging.ERROR, 'Error while executing method handler "{}" (id={})',
+                     req.method, req.rpc_id, traceback=True, repeat_key=req.method)
             if isinstance(e, jsonrpc.Error):
                 return e
             else:
@@ -122,7 +214,7 @@ class RootController:
         if not _jsonrpc_conf.threaded_batch:
             # Если отключена опция выполнения батча в разных потоках,
             # то он весь будет исполнен в текущем последовательно
-            single = request
+            single = request.requests
         else:
             # Разбираем батч
             for r in request.requests:
@@ -130,6 +222,10 @@ class RootController:
                     # Это ошибка парсинга, отправляем ее в результат напрямую
                     res.append(r)
                     continue
+                if r.rpc_id is None and _jsonrpc_conf.async_notifications:
+                    # Notification только ставится в фоновый пул, ждать в потоках нечего
+                    single.append(r)
+                    continue
                 if getattr(self._find_method(r.method), '__rpc_atomic', False):
                     # У найденного метода есть флаг атомарного выполнения, в текущий поток его
                     single.append(r)
@@ -156,8 +252,8 @@ class RootController:
                     r.extend(filter(lambda x: x[1].done(), f))
                     f[:] = filter(lambda x: not x[1].done(), f)
                     if time.time() >= etime:
-                        cherrypy.log('Timeout while batch-executing: %d threads still running' %
-                                     len(f), 'RPC', severity=logging.ERROR)
+                        logs.log('RPC', logging.ERROR, 'Timeout while batch-executing: {} threads still running',
+                                 len(f))
                         break
                     if f:
                         time.sleep(0.1)
@@ -174,44 +270,122 @@ class RootController:
                     else:
                         res.append((req.rpc_id, fr))
 
-                for req, _ in f:
+                for req, future in f:
                     # По всем зависшим запросам отдается таймаут
                     res.append(jsonrpc.Error(
                         req.rpc_id, code=jsonrpc.Error.TIMEOUT))
+                    request.running.append(future)
 
                 pool.shutdown(False)
 
         # Выполняем все однопоточные запросы
         for r in single:
-            res.append(self._exec_single(r))
+            fr = self._exec_single(r)
+            if isinstance(r, jsonrpc.Error) or isinstance(fr, jsonrpc.Error):
+                res.append(fr)
+            elif r.rpc_id is not None:
+                res.append((r.rpc_id, fr))
 
         return res
 
+    def _client_id(self):
+        '''
+        Идентификатор клиента для лимитов
+        '''
+        request = cherrypy.request
+        if _jsonrpc_conf.client_header:
+            client = request.headers.get(_jsonrpc_conf.client_header)
+            if client:
+                return client
+        return request.remote.ip
+
+    def _admit(self, req: jsonrpc.SingleRequest, client):
+        '''
+        Допуск вызова. Возвращает jsonrpc.Error при отказе
+        '''
+        method = self._find_method(req.method)
+        # Несуществующие методы учитываются вместе, чтобы не копить счетчики на произвольные имена
+        refusal = admission.admit(client, req.method if method else None,
+                                  getattr(method, '__rpc_rate_limit', None))
+        if refusal is None:
+            return None
+        code = jsonrpc.Error.RATE_LIMITED if refusal == admission.RATE_LIMITED else jsonrpc.Error.OVERLOADED
+        return jsonrpc.Error(req.rpc_id, code=code)
+
     @cherrypy.expose
     @cherrypy.tools.no_request_procesing()
     def default(self, *_vpath, **_params):
         '''
         Обработчик по умолчанию
         '''
-        # парсим реквест
-        req = jsonrpc.parse_request(
-            cherrypy.request.body.fp, _jsonrpc_conf.encoding)
-
-        if isinstance(req, jsonrpc.BatchRequest):
-            # Ставим на выполнение пачку и ждем, пока они не выполнятся
-            resp = jsonrpc.batch_result(self._exec_batch(req))
+        # Запись запроса для chips.replay
+        captured = _jsonrpc_conf.capture_file and (_jsonrpc_conf.capture_sample >= 1 or
+                                                   random.random() < _jsonrpc_conf.capture_sample)
+        if captured:
+            stamp = time.time()
+            stime = time.perf_counter()
+            raw = cherrypy.request.body.fp.read()
+            req = jsonrpc.parse_request(raw, _jsonrpc_conf.encoding)
         else:
-            # В основном потоке выполняем метод
-            resp = jsonrpc.single_result(
-                req.rpc_id, self._exec_single(req))
+            # парсим реквест
+            req = jsonrpc.parse_request(
+                cherrypy.request.body.fp, _jsonrpc_conf.encoding)
+
+        admitted = 0
+        try:
+            if admission.enabled() and not isinstance(req, jsonrpc.Error):
+                # Отказанные вызовы заменяются ошибками и не выполняются,
+                # отказанные notifications из батча удаляются - ответ на них не отправляется
+                client = self._client_id()
+                if isinstance(req, jsonrpc.BatchRequest):
+                    requests = []
+                    for r in req.requests:
+                        if isinstance(r, jsonrpc.Error):
+                            requests.append(r)
+                            continue
+                        refusal = self._admit(r, client)
+                        if not refusal:
+                            admitted += 1
+                            requests.append(r)
+                        elif r.rpc_id is not None:
+                            requests.append(refusal)
+                    req.requests = requests
+                else:
+                    refusal = self._admit(req, client)
+                    if refusal:
+                        req = refusal
+                    else:
+                        admitted += 1
+
+            if isinstance(req, jsonrpc.BatchRequest):
+                # Ставим на выполнение пачку и ждем, пока они не выполнятся.
+                # Если в батче только notifications, ответ пустой
+                resp = jsonrpc.batch_result(self._exec_batch(req)) or None
+            elif isinstance(req, jsonrpc.Error):
+                resp = jsonrpc.single_result(req.rpc_id, req)
+            else:
+                # В основном потоке выполняем метод
+                resp = jsonrpc.single_result(
+                    req.rpc_id, self._exec_single(req))
+        finally:
+            if admitted:
+                # Слоты зависших элементов батча освобождаются по их завершении
+                running = req.running if isinstance(req, jsonrpc.BatchRequest) else ()
+                admission.release(admitted - len(running))
+                for future in running:
+                    future.add_done_callback(lambda _: admission.release())
 
         response = cherrypy.response
         response.status = '200 OK'
         if resp is not None:
-            response.body = json.dumps(resp).encode(_jsonrpc_conf.encoding)
+            body = json.dumps(resp).encode(_jsonrpc_conf.encoding)
+            response.body = body
             response.headers['Content-Type'] = 'text/json; charset=%s' % _jsonrpc_conf.encoding
-            response.headers['Content-Length'] = len(response.body)
+            response.headers['Content-Length'] = len(body)
         else:
-            response.body = b''
+            body = response.body = b''
+
+        if captured:
+            recorder.put(stamp, time.perf_counter() - stime, len(body), raw)
 
         return response.body
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+
+import cherrypy
+import os
+import select
+import signal
+import socket
+import threading
+import time
+import logging
+from cherrypy import _cpwsgi_server
+from cherrypy.process.plugins import Daemonizer, PIDFile, Monitor
+from cherrypy.process.servers import ServerAdapter
+
+from . import plugins
+
+
+def prefork(workers=None, bus=None, ready_timeout=30, stop_timeout=30):
+    '''
+    Запуск сервера в многопроцессном (prefork) режиме.
+
+    Процесс-мастер открывает слушающий сокет по адресу из конфигурации
+    ``cherrypy.server`` и порождает ``workers`` процессов-воркеров, которые
+    принимают соединения с этого общего сокета. Мастер остается однопоточным
+    и не запускает шину, он только следит за воркерами:
+
+        - умерший воркер перезапускается;
+        - по SIGHUP воркеры по одному заменяются новыми (новый воркер
+          запускается, дожидаемся его готовности, после чего старому
+          отправляется SIGTERM), сокет при этом не закрывается;
+        - по SIGTERM/SIGINT все воркеры останавливаются, мастер завершается.
+
+    В мастере функция не возвращает управление, в воркере она возвращает
+    номер его слота (0..workers-1), после чего воркер запускает шину как обычно.
+
+    Плагины шины выполняются только в воркерах. Режим их запуска определяется
+    атрибутом плагина ``prefork_mode``:
+
+        :'every': плагин работает в каждом воркере. Так по умолчанию работают
+            ``bg_tasks_queue`` (задачи ставятся обработчиками запросов своего
+            процесса) и ``starter_stopper`` (прогрев кэшей и соединений каждого
+            процесса);
+        :'primary': плагин работает только в воркере со слотом 0, который
+            мастер перезапускает при падении так же, как и остальные. Так по
+            умолчанию работает ``task_manager``, чтобы периодические задачи не
+            выполнялись N раз.
+
+    Плагины ``Daemonizer`` и ``PIDFile``, подключенные через :func:`daemonize`,
+    выполняются в мастере. ``DropPrivileges`` выполняется в каждом воркере уже
+    после открытия сокета, поэтому можно использовать привилегированные порты.
+
+    *Пример:*
+
+    .. code-block:: python
+
+        cherrypy.tree.mount(Root(), '')
+        chips.daemonize('www-data', 'www-data', '/run/app.pid')
+        chips.prefork(workers=4)
+
+        cherrypy.engine.signals.subscribe()
+        cherrypy.engine.start()
+        cherrypy.engine.block()
+
+    :param workers: Количество воркеров, по умолчанию - количество процессоров
+    :param bus: Шина, по умолчанию ``cherrypy.engine``
+    :param ready_timeout: Время ожидания готовности нового воркера при перезагрузке (включая
+        критические задачи ``starter_stopper``), сек
+    :param stop_timeout: Время ожидания завершения воркеров, после которого они убиваются, сек
+    '''
+    return Prefork(workers, bus, ready_timeout, stop_timeout).run()
+
+
+class _BecomeWorker(Exception):
+    '''Выброс из цикла мастера в порожденном процессе'''
+
+    def __init__(self, slot):
+        self.slot = slot
+
+
+class _InheritedSocketServer(_cpwsgi_server.CPWSGIServer):
+    '''
+    HTTP-сервер, использующий уже открытый мастером сокет вместо создания нового
+    '''
+
+    def __init__(self, server_adapter, sock):
+        super(_InheritedSocketServer, self).__init__(server_adapter)
+        self.inherited_socket = sock
+
+    def bind(self, family, type, proto=0):
+        self.socket = self.inherited_socket
+        return self.socket
+
+
+class WorkerServer(ServerAdapter):
+    '''
+    Адаптер HTTP-сервера воркера. Порт занят мастером и остальными воркерами,
+    поэтому проверки его освобождения при запуске и остановке не выполняются.
+    '''
+
+    def __init__(self, bus, sock, server=None):
+        server = server or cherrypy.server
+        super(WorkerServer, self).__init__(
+            bus, _InheritedSocketServer(server, sock), server.bind_addr)
+
+    def start(self):
+        if self.running:
+            return
+        self.interrupt = None
+        t = threading.Thread(target=self._start_http_thread)
+        t.name = 'HTTPServer ' + t.name
+        t.start()
+        self.wait()
+        self.running = True
+        self.bus.log('Serving on %s (pid %d)' % (self.description, os.getpid()))
+    start.priority = 75
+
+    def stop(self):
+        if self.running:
+            self.httpserver.stop()
+            self.running = False
+            self.bus.log('HTTP Server %s shut down' % self.httpserver)
+    stop.priority = 25
+
+
+class Prefork:
+    '''
+    Мастер-процесс prefork-режима, см. :func:`prefork`
+    '''
+
+    def __init__(self, workers=None, bus=None, ready_timeout=30, stop_timeout=30):
+        self.workers = workers or os.cpu_count() or 1
+        self.bus = bus or cherrypy.engine
+        self.ready_timeout = ready_timeout
+        self.stop_timeout = stop_timeout
+        self.socket = None
+        self.children = {}  # pid -> slot
+        self.respawn_at = {}  # slot -> время, раньше которого слот не перезапускается
+        self.stopping = False
+        self.reloading = False
+        self.master_pid = None
+        self.slot = None
+        self._wakeup = None
+        self._ready_fd = None
+        self._master_plugins = []
+
+    def _find_plugins(self, predicate):
+        res = []
+        for listener in list(self.bus.listeners['start']):
+            plugin = getattr(listener, '__self__', None)
+            if plugin is not None and plugin not in res and predicate(plugin):
+                res.append(plugin)
+        return res
+
+    def _bind(self):
+        server = cherrypy.server
+        if not isinstance(server.bind_addr, tuple):
+            raise ValueError('Prefork mode supports only TCP sockets')
+        host, port = server.bind_addr
+        af, socktype, proto, _, addr = socket.getaddrinfo(
+            host, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, socket.AI_PASSIVE)[0]
+        sock = socket.socket(af, socktype, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if server.nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.bind(addr)
+        sock.listen(server.socket_queue_size)
+        self.socket = sock
+        self.bus.log('Prefork master listening on %s:%d' % sock.getsockname()[:2])
+
+    def _signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reloading = True
+        elif signum in (signal.SIGTERM, signal.SIGINT):
+            self.stopping = True
+
+    def _install_signals(self):
+        r, w = os.pipe()
+        os.set_blocking(r, False)
+        os.set_blocking(w, False)
+        self._wakeup = (r, w)
+        signal.set_wakeup_fd(w)
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signum, self._signal)
+
+    def _sleep(self, timeout):
+        r = self._wakeup[0]
+        if select.select([r], [], [], timeout)[0]:
+            try:
+                while os.read(r, 64):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def _spawn(self, slot):
+        '''
+        Порождение воркера для слота. Возвращает (pid, fd канала готовности) в мастере,
+        в воркере выбрасывает _BecomeWorker
+        '''
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            self._ready_fd = w
+            raise _BecomeWorker(slot)
+        os.close(w)
+        self.children[pid] = slot
+        self.respawn_at[slot] = time.time() + 1
+        self.bus.log('Spawned worker %d (pid %d)' % (slot, pid))
+        return pid, r
+
+    def _wait_ready(self, pid, fd):
+        '''
+        Ожидание готовности воркера: он пишет в канал после запуска шины
+        '''
+        etime = time.time() + self.ready_timeout
+        try:
+            while not self.stopping and time.time() < etime and pid in self.children:
+                if select.select([fd], [], [], 0.5)[0]:
+                    return bool(os.read(fd, 1))
+                self._reap()
+            return False
+        finally:
+            os.close(fd)
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            slot = self.children.pop(pid, None)
+            if slot is not None:
+                level = logging.INFO if self.stopping else logging.WARNING
+                self.bus.log('Worker %d (pid %d) exited with status %d' %
+                             (slot, pid, os.waitstatus_to_exitcode(status)), level)
+
+    def _respawn(self):
+        active = set(self.children.values())
+        now = time.time()
+        for slot in range(self.workers):
+            if slot not in active and now >= self.respawn_at.get(slot, 0):
+                os.close(self._spawn(slot)[1])
+
+    def _reload(self):
+        '''
+        Поочередная замена воркеров без закрытия сокета
+        '''
+        self.bus.log('Reloading workers')
+        for slot in range(self.workers):
+            if self.stopping:
+                return
+            old = [pid for pid, s in self.children.items() if s == slot]
+            pid, fd = self._spawn(slot)
+            if not self._wait_ready(pid, fd):
+                self.bus.log('Worker %d (pid %d) is not ready, reload aborted' % (slot, pid),
+                             logging.ERROR)
+                return
+            for old_pid in old:
+                self._kill(old_pid, signal.SIGTERM)
+
+    def _kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _shutdown(self):
+        self.bus.log('Stopping workers')
+        for pid in list(self.children):
+            self._kill(pid, signal.SIGTERM)
+        etime = time.time() + self.stop_timeout
+        while self.children and time.time() < etime:
+            self._reap()
+            if self.children:
+                self._sleep(0.2)
+        for pid in list(self.children):
+            self.bus.log('Killing worker pid %d' % pid, logging.WARNING)
+            self._kill(pid, signal.SIGKILL)
+        while self.children:
+            pid, _ = os.waitpid(-1, 0)
+            self.children.pop(pid, None)
+        self.socket.close()
+        for plugin in self._master_plugins:
+            if hasattr(plugin, 'exit'):
+                plugin.exit()
+        self.bus.log('Prefork master stopped')
+
+    def _serve(self):
+        self._bind()
+
+        # Демонизация и PID-файл относятся к мастеру
+        self._master_plugins = self._find_plugins(
+            lambda p: isinstance(p, (Daemonizer, PIDFile)))
+        for plugin in sorted(self._master_plugins, key=lambda p: p.start.priority):
+            plugin.unsubscribe()
+            plugin.start()
+        self.master_pid = os.getpid()
+
+        self._install_signals()
+        while not self.stopping:
+            self._reap()
+            if self.reloading:
+                self.reloading = False
+                self._reload()
+            if not self.stopping:
+                self._respawn()
+                self._sleep(1)
+        self._shutdown()
+
+    def _setup_worker(self, slot):
+        self.slot = slot
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        signal.set_wakeup_fd(-1)
+        os.close(self._wakeup[0])
+        os.close(self._wakeup[1])
+        # Перезагрузкой управляет мастер
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        handler = getattr(self.bus, 'signal_handler', None)
+        if handler:
+            handler.handlers.pop('SIGHUP', None)
+
+        self.bus.prefork_slot = slot
+        for plugin in self._find_plugins(lambda p: not plugins.prefork_allowed(self.bus, p)):
+            plugin.unsubscribe()
+
+        cherrypy.server.unsubscribe()
+        self.bus.prefork_server = WorkerServer(self.bus, self.socket)
+        self.bus.prefork_server.subscribe()
+        self.bus.prefork_watchdog = Monitor(self.bus, self._check_master, 1, 'PreforkWatchdog')
+        self.bus.prefork_watchdog.subscribe()
+        self.bus.subscribe('start', self._notify_ready, priority=100)
+        self.bus.subscribe('ready', self._notify_ready)
+
+    def _notify_ready(self):
+        starter = getattr(self.bus, 'starter_stopper', None)
+        if isinstance(starter, plugins.LazyPlugin):
+            starter = starter.plugin
+        if isinstance(starter, plugins.StarterStopper) and not starter.ready.is_set():
+            return  # воркер будет готов после критических задач запуска (канал 'ready')
+        fd, self._ready_fd = self._ready_fd, None
+        if fd is None:
+            return
+        try:
+            os.write(fd, b'1')
+        except OSError:
+            pass
+        os.close(fd)
+
+    def _check_master(self):
+        if os.getppid() != self.master_pid:
+            self.bus.log('Prefork master is gone, exiting', logging.ERROR)
+            self.bus.exit()
+
+    def run(self):
+        try:
+            self._serve()
+        except _BecomeWorker as e:
+            self._setup_worker(e.slot)
+            return e.slot
+        raise SystemExit(0)